@@ -0,0 +1,92 @@
+import gzip
+import io
+
+# This module contains the export engine used by the /export_* commands and admin.py
+
+PAGE_SIZE = 1000
+# Discord's upload limit for servers without boosts
+UPLOAD_LIMIT = 8 * 1024 * 1024
+# Room left in every part for the rest of the upload request and the compressor's pending output
+PART_MARGIN = 256 * 1024
+
+
+def new_export_summary():
+    """Returns an empty export summary"""
+    return {"accounts": 0, "parts": 0, "bytes": 0}
+
+
+def iter_accounts(controller, status=None, since=None, until=None, page_size=PAGE_SIZE):
+    """Iterates over the accounts of a MongoController one page at a time"""
+    after = None
+    while True:
+        page = controller.get_accounts_page(status, since, until, after, page_size)
+        for acc in page:
+            yield acc['account']
+        if len(page) < page_size:
+            return
+        after = page[-1]['_id']
+
+
+async def aiter_accounts(controller, status=None, since=None, until=None, page_size=PAGE_SIZE):
+    """Iterates over the accounts of an AsyncMongoController one page at a time"""
+    after = None
+    while True:
+        page = await controller.get_accounts_page(status, since, until, after, page_size)
+        for acc in page:
+            yield acc['account']
+        if len(page) < page_size:
+            return
+        after = page[-1]['_id']
+
+
+class ExportPart:
+    """In-memory file of one export attachment, optionally gzip compressed"""
+
+    def __init__(self, name, compress=False):
+        self.buffer = io.BytesIO()
+        self.compress = compress
+        self.name = name + (".txt.gz" if compress else ".txt")
+        self.writer = gzip.GzipFile(fileobj=self.buffer, mode="wb", filename=name + ".txt") if compress else self.buffer
+        self.accounts = 0
+
+    def size(self):
+        """Returns the number of bytes written to the buffer so far"""
+        return self.buffer.tell()
+
+    def write(self, account):
+        self.writer.write(account.encode("utf-8") + b"\n")
+        self.accounts += 1
+
+    def close(self):
+        """Finishes the file and returns the buffer ready to be read"""
+        if self.compress:
+            self.writer.close()
+        size = self.buffer.tell()
+        self.buffer.seek(0)
+        return self.buffer, size
+
+
+async def export_accounts(controller, name, send, status=None, since=None, until=None, compress=False, upload_limit=UPLOAD_LIMIT, page_size=PAGE_SIZE):
+    """Streams accounts of an AsyncMongoController into attachments under upload_limit, send is awaited with every (filename, buffer)"""
+    # Only one part is held in memory at a time, it is sent as soon as it is full
+    summary = new_export_summary()
+    part_limit = max(upload_limit - PART_MARGIN, upload_limit // 2)
+    part = None
+
+    async def flush(part):
+        buffer, size = part.close()
+        summary["parts"] += 1
+        summary["bytes"] += size
+        await send(part.name if summary["parts"] == 1 else part.name.replace(name, f"{name}_{summary['parts']}", 1), buffer)
+
+    async for account in aiter_accounts(controller, status, since, until, page_size):
+        if part is None:
+            part = ExportPart(name, compress)
+        part.write(account)
+        summary["accounts"] += 1
+        if part.size() >= part_limit:
+            await flush(part)
+            part = None
+    if part is not None:
+        await flush(part)
+    return summary
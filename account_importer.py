@@ -0,0 +1,59 @@
+import io
+import time
+
+# This module contains the import engine used by /import_accounts and admin.py
+
+BATCH_SIZE = 1000
+
+
+def new_import_summary():
+    """Returns an empty import summary"""
+    return {"inserted": 0, "updated": 0, "skipped": 0, "total": 0}
+
+
+def iter_lines(data, encoding="utf-8"):
+    """Iterates over the lines of a bytes payload without splitting it all at once"""
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding, errors="replace")
+
+
+def iter_account_batches(lines, summary, batch_size=BATCH_SIZE):
+    """Yields batches of unique accounts, blank lines and duplicates in the file are skipped"""
+    seen = set()
+    batch = []
+    for line in lines:
+        summary["total"] += 1
+        account = line.strip('\r\n ')
+        if account == "" or account in seen:
+            summary["skipped"] += 1
+            continue
+        seen.add(account)
+        batch.append(account)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_accounts(controller, lines, status, batch_size=BATCH_SIZE):
+    """Imports accounts with a MongoController, returns the import summary"""
+    summary = new_import_summary()
+    for batch in iter_account_batches(lines, summary, batch_size):
+        inserted, updated = controller.bulk_upsert_accounts(batch, status)
+        summary["inserted"] += inserted
+        summary["updated"] += updated
+    return summary
+
+
+async def import_accounts_async(controller, lines, status, progress=None, batch_size=BATCH_SIZE, progress_interval=2):
+    """Imports accounts with an AsyncMongoController, progress is awaited with the summary every few seconds"""
+    summary = new_import_summary()
+    last_progress = time.monotonic()
+    for batch in iter_account_batches(lines, summary, batch_size):
+        inserted, updated = await controller.bulk_upsert_accounts(batch, status)
+        summary["inserted"] += inserted
+        summary["updated"] += updated
+        if progress is not None and time.monotonic() - last_progress >= progress_interval:
+            last_progress = time.monotonic()
+            await progress(summary)
+    return summary
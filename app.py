@@ -1,25 +1,120 @@
 import discord
 from discord.ext import commands
+from discord import app_commands
 import logging
 from cogs.Ticket import TicketMenu
 from mongo_controller import MongoController
+from async_mongo_controller import AsyncMongoController
+from binance_controller import BinanceController
+from deposit_indexer import DepositIndexer
+from payment_matcher import PaymentMatcher
+from ticket_registry import TicketRegistry
+from hold_scheduler import HoldScheduler
+from audit_logger import AuditLogger
+from metrics import metrics, start_http_server
 from dotenv import load_dotenv
+import asyncio
 import os
+import time
+
+class InstrumentedTree(app_commands.CommandTree):
+    """Command tree that records the latency of every app command"""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        if interaction.command is not None and "started" in interaction.extras:
+            metrics.observe("command", interaction.command.qualified_name, time.perf_counter() - interaction.extras["started"], error=True)
+        await super().on_error(interaction, error)
+
 
 class Client(commands.Bot):
     def __init__(self):
-        super().__init__(command_prefix=commands.when_mentioned_or('!'), intents=discord.Intents.all())
+        super().__init__(command_prefix=commands.when_mentioned_or('!'), intents=discord.Intents.all(), tree_cls=InstrumentedTree)
+
+    async def on_app_command_completion(self, interaction: discord.Interaction, command):
+        if "started" in interaction.extras:
+            metrics.observe("command", command.qualified_name, time.perf_counter() - interaction.extras["started"])
     
     async def on_ready(self):
         print("Bot is ready")
+        # Tickets whose channel was deleted while the bot was offline
+        await self.tickets.reconcile({channel.id for guild in self.guilds for channel in guild.channels})
         await self.tree.sync()
     
     async def setup_hook(self) -> None:
-        self.add_view(TicketMenu())
+        # Shared database controller, every cog and view uses this pool
+        self.mongo = AsyncMongoController(MongoController())
+        # Indexes are declared in mongo_controller.INDEXES, the TTL of pending checkout sessions included
+        if await self.mongo.create_indexes():
+            print("Some database indexes could not be created, see /index_report")
+        # The finance dashboards read the daily rollups, they are built from the statements on the first start
+        if await self.mongo.ensure_finance_rollups():
+            print("Finance rollups built from the existing statements")
+        # Prometheus metrics, only served when a port is configured
+        if os.getenv('METRICS_PORT'):
+            self.metrics_runner = await start_http_server(int(os.getenv('METRICS_PORT')))
+        # Command log shared by the cogs, sent to the log channel in batches
+        self.audit = AuditLogger(self, int(os.getenv('AUDIT_CHANNEL_ID', 1073219018586066944)), self.mongo if os.getenv('AUDIT_PERSIST', '0') == '1' else None, float(os.getenv('AUDIT_FLUSH_INTERVAL', 2)))
+        self.audit.start()
+        # Stock is counted in memory, recounted every few minutes in case something else wrote to the accounts
+        await self.mongo.reconcile_stock()
+        self.stock_task = asyncio.create_task(self.reconcile_stock_loop(int(os.getenv('STOCK_RECONCILE_INTERVAL', 300))))
+        # Shared Binance client, keeps its connections open between requests
+        self.binance = BinanceController()
+        await self.binance.start()
+        # txid -> deposit index, polled in the background
+        self.deposits = DepositIndexer(self.binance, self.mongo)
+        await self.deposits.start()
+        # Completes checkouts as soon as the indexer sees a matching deposit
+        self.payments = PaymentMatcher(self)
+        self.payments.start()
+        # Open tickets, kept in memory so ticket buttons and commands don't query the database
+        self.tickets = TicketRegistry(self.mongo)
+        await self.tickets.load()
+        self.add_view(TicketMenu(self.mongo, self.tickets))
+        # Expires checkout sessions and releases the accounts held for them
+        self.holds = HoldScheduler(self)
+        await self.holds.start()
         await self.load_extension('cogs.Ticket')
         await self.load_extension('cogs.Shop')
         await self.load_extension('cogs.Admin')
 
+    async def reconcile_stock_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                drift = await self.mongo.reconcile_stock()
+                if drift:
+                    logging.getLogger(__name__).warning("Stock counter was off by %s", drift)
+            except Exception:
+                logging.getLogger(__name__).exception("Stock reconcile failed")
+            # Holds whose session expired without releasing them would stay out of stock until the next restart
+            try:
+                await self.holds.sweep()
+            except Exception:
+                logging.getLogger(__name__).exception("Hold sweep failed")
+
+    async def close(self):
+        # Send the last log entries while the connection is still open
+        if hasattr(self, "audit"):
+            await self.audit.close()
+        await super().close()
+        if hasattr(self, "stock_task"):
+            self.stock_task.cancel()
+        if hasattr(self, "deposits"):
+            self.deposits.close()
+        if hasattr(self, "holds"):
+            self.holds.close()
+        if hasattr(self, "binance"):
+            await self.binance.close()
+        if hasattr(self, "metrics_runner"):
+            await self.metrics_runner.cleanup()
+        if hasattr(self, "mongo"):
+            self.mongo.close()
+
 
 class Modal(discord.ui.Modal, title="Modal"):
     field1 = discord.ui.TextInput(label="label", placeholder="Field 1", min_length=3, max_length=10)
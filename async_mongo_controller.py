@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.cursor import Cursor
+from pymongo.command_cursor import CommandCursor
+from dotenv import load_dotenv
+from metrics import metrics
+import asyncio
+import functools
+import os
+
+
+class AsyncMongoController:
+    """Awaitable version of MongoController, every method runs on a bounded thread pool"""
+
+    # Methods that go through whole collections, they get their own smaller pool
+    # so exports and reports can't take the workers that checkouts need
+    BULK_METHODS = {
+        "get_all_accounts",
+        "get_all_bad_accounts",
+        "get_all_sold_accounts",
+        "get_all_uncartable_accounts",
+        "get_all_cartable_accounts",
+        "get_accounts_page",
+        "reconcile_stock",
+        "get_all_clients",
+        "get_all_tickets",
+        "get_client_with_most_revenue",
+        "get_client_leaderboard",
+        "backfill_client_counters",
+        "migrate_client_purchases",
+        "basic_finance_dashboard",
+        "finance_timeseries",
+        "rebuild_finance_rollups",
+        "ensure_finance_rollups",
+        "bulk_upsert_accounts",
+        "get_all_deposits",
+        "insert_audit_entries",
+        "create_indexes",
+        "missing_indexes",
+        "explain_hot_queries",
+    }
+
+    def __init__(self, controller, max_workers=None, bulk_workers=None):
+        load_dotenv()
+        self.controller = controller
+        self.max_workers = max_workers or int(os.getenv('MONGO_WORKERS', controller.max_pool_size))
+        self.bulk_workers = bulk_workers or int(os.getenv('MONGO_BULK_WORKERS', 2))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="mongo")
+        self.bulk_executor = ThreadPoolExecutor(max_workers=self.bulk_workers, thread_name_prefix="mongo-bulk")
+
+    def __getattr__(self, name):
+        attribute = getattr(self.controller, name)
+        if not callable(attribute):
+            return attribute
+        executor = self.bulk_executor if name in self.BULK_METHODS else self.executor
+
+        # The latency includes the wait for a free worker
+        @metrics.timed("mongo", name)
+        @functools.wraps(attribute)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(self._call, attribute, *args, **kwargs))
+        return wrapper
+
+    @staticmethod
+    def _call(method, *args, **kwargs):
+        result = method(*args, **kwargs)
+        # Cursors would do their network I/O on the event loop when iterated, read them here
+        if isinstance(result, (Cursor, CommandCursor)):
+            return list(result)
+        return result
+
+    def get_pool_stats(self):
+        """Returns the connection pool and worker statistics"""
+        stats = self.controller.get_pool_stats()
+        stats["workers"] = self.max_workers
+        stats["bulk_workers"] = self.bulk_workers
+        return stats
+
+    def close(self):
+        """Stops the worker threads and closes the connection pool"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.bulk_executor.shutdown(wait=True, cancel_futures=True)
+        self.controller.close()
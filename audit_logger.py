@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Discord's message length limit
+MESSAGE_LIMIT = 2000
+# Every message is one code block
+BLOCK_OVERHEAD = len("```\n```")
+
+
+def pack_lines(lines, limit=MESSAGE_LIMIT):
+    """Packs lines into as few code block messages under limit as possible"""
+    messages, block = [], ""
+    for line in lines:
+        line = line[:limit - BLOCK_OVERHEAD - 1]
+        if block and len(block) + len(line) + 1 + BLOCK_OVERHEAD > limit:
+            messages.append(f"```\n{block}```")
+            block = ""
+        block += line + "\n"
+    if block:
+        messages.append(f"```\n{block}```")
+    return messages
+
+
+class AuditLogger:
+    """Background command log shared by the cogs, entries are queued and sent to the log channel in batches"""
+
+    def __init__(self, client, channel_id, mongo=None, interval=2, max_queue=10000):
+        self.client = client
+        self.channel_id = channel_id
+        # Entries are also saved to the AuditLog collection when a controller is given
+        self.mongo = mongo
+        self.interval = interval
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+        # Entry taken off the queue by the flush loop while it waits for the window
+        self.pending = []
+        self.task = None
+
+    def start(self):
+        """Starts the flush loop"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._flush_loop())
+
+    def log(self, member, action):
+        """Queues an entry, never waits"""
+        try:
+            self.queue.put_nowait({"member": str(member), "member_id": getattr(member, "id", None), "action": action, "date": datetime.now()})
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def alert(self, message):
+        """Sends a message a moderator has to act on to the log channel right away"""
+        logger.warning(message)
+        channel = self.client.get_channel(self.channel_id)
+        if channel is None:
+            logger.warning("Audit log channel %s not found, alert not sent", self.channel_id)
+            return
+        await channel.send(message)
+
+    async def close(self):
+        """Stops the flush loop and sends what is left in the queue"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    def _drain(self):
+        entries = []
+        while not self.queue.empty():
+            entries.append(self.queue.get_nowait())
+        return entries
+
+    async def _flush_loop(self):
+        while True:
+            # Sleep until something is logged, then give the window time to fill
+            self.pending.append(await self.queue.get())
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Audit log flush failed")
+
+    async def flush(self):
+        """Sends the queued entries to the log channel and saves them"""
+        entries, self.pending = self.pending + self._drain(), []
+        if self.dropped:
+            logger.warning("Audit log queue was full, %s entries dropped", self.dropped)
+            self.dropped = 0
+        if not entries:
+            return
+        if self.mongo is not None:
+            # The batch is still posted to the channel when the database write fails
+            try:
+                await self.mongo.insert_audit_entries(entries)
+            except Exception:
+                logger.exception("Could not save %s audit log entries", len(entries))
+        channel = self.client.get_channel(self.channel_id)
+        if channel is None:
+            logger.warning("Audit log channel %s not found, %s entries not sent", self.channel_id, len(entries))
+            return
+        for message in pack_lines(f"[{entry['member']}] -> [{entry['action']}]" for entry in entries):
+            await channel.send(message)
@@ -0,0 +1,252 @@
+from mongo_controller import MongoController
+from async_mongo_controller import AsyncMongoController
+from binance_controller import BinanceController
+from deposit_indexer import DepositIndexer
+from account_importer import import_accounts_async
+from account_exporter import export_accounts
+from checkout import fulfil_checkout
+from ticket_registry import TicketRegistry
+from metrics import metrics
+from datetime import datetime, timedelta
+from aiohttp import web
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+
+# This program benchmarks the order, import and reporting hot paths against a local mongod and a fake Binance
+# Usage: python benchmark.py --mongo-url mongodb://localhost:27017 [--compare benchmark_results/<file>.json]
+
+RESULTS_DIR = "benchmark_results"
+# Never the production database, it is dropped before every run
+DATABASE = "PlugBotBenchmark"
+PAYMENT_METHODS = ["USDT", "LTC", "BTC", "ETH", "Revolut", "Binance Pay ID"]
+PRICES = [{"step": 1, "price": 1.5}, {"step": 10, "price": 1.2}, {"step": 50, "price": 1.0}, {"step": 200, "price": 0.8}]
+
+
+def fake_deposits(n_deposits):
+    """Returns n_deposits credited deposits, one a minute until now"""
+    now = int(time.time() * 1000)
+    return [{"id": str(i), "amount": f"{random.uniform(5, 500):.2f}", "coin": random.choice(["USDT", "LTC", "BTC", "ETH"]),
+             "network": "TRX", "status": 1, "address": "address", "txId": f"tx{i}", "insertTime": now - (n_deposits - i) * 60000}
+            for i in range(n_deposits)]
+
+
+def fake_binance_app(deposits, latency):
+    """Returns an aiohttp app that answers the Binance endpoints used by BinanceController, deposits can be appended to while it runs"""
+
+    async def delay():
+        if latency:
+            await asyncio.sleep(latency)
+
+    async def exchange_info(request):
+        await delay()
+        symbols = [{"symbol": base + quote, "baseAsset": base, "quoteAsset": quote, "status": "TRADING"} for base, quote in [("BTC", "EUR"), ("ETH", "EUR"), ("LTC", "EUR"), ("EUR", "USDT")]]
+        return web.json_response({"symbols": symbols})
+
+    async def ticker_price(request):
+        await delay()
+        return web.json_response({"symbol": request.query["symbol"], "price": "1.08"})
+
+    async def coin_config(request):
+        await delay()
+        return web.json_response([{"coin": coin, "networkList": [{"network": "TRX", "name": "Tron (TRC20)"}, {"network": "BSC", "name": "BNB Smart Chain (BEP20)"}]} for coin in ["USDT", "LTC", "BTC", "ETH"]])
+
+    async def deposit_address(request):
+        await delay()
+        return web.json_response({"coin": request.query["coin"], "address": "address", "tag": "", "url": ""})
+
+    async def deposit_history(request):
+        await delay()
+        page = deposits
+        if "txId" in request.query:
+            page = [deposit for deposit in page if deposit["txId"] == request.query["txId"]]
+        if "startTime" in request.query:
+            page = [deposit for deposit in page if deposit["insertTime"] >= int(request.query["startTime"])]
+        offset, limit = int(request.query.get("offset", 0)), int(request.query.get("limit", 1000))
+        return web.json_response(page[offset:offset + limit], headers={"x-sapi-used-ip-weight-1m": "1"})
+
+    app = web.Application()
+    app.router.add_get("/api/v3/exchangeInfo", exchange_info)
+    app.router.add_get("/api/v3/ticker/price", ticker_price)
+    app.router.add_get("/sapi/v1/capital/config/getall", coin_config)
+    app.router.add_get("/sapi/v1/capital/deposit/address", deposit_address)
+    app.router.add_get("/sapi/v1/capital/deposit/hisrec", deposit_history)
+    return app
+
+
+def seed(controller, n_clients, n_days, statements_per_day):
+    """Seeds prices, clients with purchase histories and finance statements, returns the client ids"""
+    db = controller.db
+    db["Prices"].insert_many([dict(price) for price in PRICES])
+    start = datetime.now() - timedelta(days=n_days)
+    client_ids = [str(10**17 + i) for i in range(n_clients)]
+    for i in range(0, n_clients, 1000):
+        clients, purchases = [], []
+        for client_id in client_ids[i:i+1000]:
+            history = [{"client_id": client_id, "Type": random.choice(["account_purchase"] * 4 + ["replacement"]), "Date": start + timedelta(minutes=random.randint(0, n_days * 1440)),
+                        "Number_of_accounts": random.randint(1, 50), "Total_price": round(random.uniform(1, 60), 2), "Payment_method": random.choice(PAYMENT_METHODS), "Account_list": []}
+                       for _ in range(random.randint(1, 10))]
+            bought = [purchase for purchase in history if purchase["Type"] == "account_purchase"]
+            revenue = sum(purchase["Total_price"] for purchase in bought)
+            clients.append({"client_id": client_id, "register_date": start, "level": 0, "legit_check": 0,
+                            "total_accounts": sum(purchase["Number_of_accounts"] for purchase in bought), "total_replacements": len(history) - len(bought),
+                            "revenue": {"account_purchase": revenue, "service": 0}, "total_revenue": revenue})
+            purchases += history
+        db["Clients"].insert_many(clients)
+        db["Purchases"].insert_many(purchases)
+    statements = [{"Type": random.choice(["Income"] * 8 + ["Expense", "Withdraw"]), "Product": "Account", "Quantity": random.randint(1, 50),
+                   "Total_Price": round(random.uniform(1, 60), 2), "Payment_Method": random.choice(PAYMENT_METHODS), "Client_id": random.choice(client_ids),
+                   "Date": start + timedelta(days=day, seconds=random.randint(0, 86399))}
+                  for day in range(n_days) for _ in range(statements_per_day)]
+    for i in range(0, len(statements), 10000):
+        db["Finance"].insert_many(statements[i:i+10000])
+    controller.rebuild_finance_rollups()
+    db["Tickets"].insert_many([{"user_id": int(client_id), "channel_id": int(client_id) + 1, "date": start} for client_id in client_ids[:1000]])
+    return client_ids
+
+
+async def run(name, operation, iterations, concurrency):
+    """Runs operation iterations times with concurrency calls in flight, every call is recorded as a bench metric"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(i):
+        async with semaphore:
+            with metrics.timer("bench", name):
+                await operation(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(iterations)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<32} {iterations / elapsed:>10.1f} ops/s")
+    return {"name": name, "iterations": iterations, "seconds": elapsed, "throughput": iterations / elapsed}
+
+
+async def benchmark(args):
+    controller = MongoController(args.mongo_url, database=DATABASE)
+    controller.client.drop_database(DATABASE)
+    mongo = AsyncMongoController(controller)
+    await mongo.create_indexes()
+    server = web.AppRunner(fake_binance_app(fake_deposits(args.deposits), args.binance_latency / 1000))
+    await server.setup()
+    await web.TCPSite(server, "127.0.0.1", args.binance_port).start()
+    binance = BinanceController("key", "secret", base_url=f"http://127.0.0.1:{args.binance_port}")
+
+    print(f"Seeding {args.clients} clients and {args.days} days of finance statements...")
+    client_ids = await asyncio.get_running_loop().run_in_executor(None, seed, controller, args.clients, args.days, args.statements_per_day)
+    n, c = args.iterations, args.concurrency
+    results = []
+    # The import also seeds the accounts the other benchmarks use
+    results.append(await run("import_accounts", lambda i: import_accounts_async(mongo, (f"account{j}@mail.com:password" for j in range(args.accounts)), "cartable"), 1, 1))
+    await mongo.reconcile_stock()
+
+    async def discard(*args, **kwargs):
+        pass
+
+    async def gen(i):
+        # /gen without the Discord calls
+        accounts = await mongo.reserve_accounts(5, f"bench-gen-{i}")
+        await mongo.insert_finance_statement({"Type": "Income", "Product": "Account", "Quantity": 5, "Unit_price": 1.2, "Total_Price": 6.0, "Payment_Method": "USDT", "Client_id": client_ids[i % len(client_ids)], "Date": datetime.now()})
+        await mongo.add_new_client_purchase(client_ids[i % len(client_ids)], {"Date": datetime.now(), "Number_of_accounts": 5, "Total_price": 6.0, "Payment_method": "USDT", "Account_list": [acc["account"] for acc in accounts]})
+
+    async def autocheckout(i):
+        # /buy, the select menus, then /autocheckout once the deposit is found: the held accounts are sold
+        checkout_session, _ = await mongo.open_checkout_session(f"bench-checkout-{i}", 3)
+        await mongo.hold_checkout_session(checkout_session)
+        await mongo.select_session_payment(checkout_session["_id"], "Crypto", "USDT")
+        await mongo.select_session_network(checkout_session["_id"], "USDT", "TRX", 3.6, 4)
+        await binance.get_deposit_history(txid=f"tx{i % args.deposits}")
+        checkout_session = await mongo.claim_checkout_session(checkout_session["_id"], f"bench-tx{i}")
+        # A session left behind would make the benchmark time less work than a real checkout
+        if checkout_session is None or not await fulfil_checkout(mongo, checkout_session, discard):
+            raise RuntimeError(f"Checkout {i} was not completed")
+
+    async def ticket(i):
+        # Open ticket button and /close, the registry writes every ticket through to the database
+        user_id, channel_id = 10**18 + i, 10**18 + n + i
+        tickets.claim(user_id)
+        await tickets.open(user_id, channel_id)
+        await tickets.close(channel_id)
+
+    async def export(i):
+        await export_accounts(mongo, "bench", discard, "cartable", compress=i % 2 == 1)
+
+    async def finance(i):
+        end = datetime.now()
+        await mongo.basic_finance_dashboard(end - timedelta(days=30 if i % 2 else 365), end)
+
+    async def poll_deposits(i):
+        indexer = DepositIndexer(binance, mongo)
+        await indexer.poll()
+
+    results.append(await run("command /gen", gen, n, c))
+    results.append(await run("command /autocheckout", autocheckout, n, c))
+    results.append(await run("command /stock", lambda i: asyncio.sleep(0, mongo.stock.get("cartable")), n, c))
+    results.append(await run("command /finance", finance, n, c))
+    results.append(await run("command /client_profile", lambda i: mongo.get_client_profile(client_ids[i % len(client_ids)]), n, c))
+    results.append(await run("command /client_history", lambda i: mongo.get_client_history(client_ids[i % len(client_ids)]), n, c))
+    results.append(await run("command /leaderboard", lambda i: mongo.get_client_leaderboard("revenue", 10), n, c))
+    results.append(await run("command /export_cartable_accounts", export, max(n // 50, 2), 1))
+    tickets = TicketRegistry(mongo)
+    await tickets.load()
+    results.append(await run("ticket open and close", ticket, n, c))
+    results.append(await run("mongo get_n_accounts_price", lambda i: mongo.get_n_accounts_price(i % 300 + 1), n, c))
+    results.append(await run("binance get_coin_price_EUR", lambda i: binance.get_coin_price_EUR("BTC"), n, c))
+    results.append(await run("binance get_deposit_address", lambda i: binance.get_deposit_address("USDT", "TRX"), n, c))
+    results.append(await run("binance deposit index poll", poll_deposits, max(n // 50, 2), 1))
+
+    await binance.close()
+    await server.cleanup()
+    mongo.close()
+    return {
+        "date": datetime.now().isoformat(),
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip(),
+        "settings": vars(args),
+        "runs": results,
+        "latency": [{key: value for key, value in row.items() if key != "total"} for row in metrics.summary()],
+    }
+
+
+def compare(old, new):
+    """Prints the p50/p99 change of every metric measured in both runs"""
+    previous = {(row["kind"], row["name"]): row for row in old["latency"]}
+    print(f"\n{'metric':<48} {'p50':>20} {'p99':>20}")
+    for row in new["latency"]:
+        before = previous.get((row["kind"], row["name"]))
+        if before is None:
+            continue
+        changes = [f"{before[q]*1000:.1f}->{row[q]*1000:.1f}ms" for q in ("p50", "p99")]
+        print(f"{row['kind'] + ' ' + row['name']:<48} {changes[0]:>20} {changes[1]:>20}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the bot hot paths against a local mongod and a fake Binance")
+    parser.add_argument("--mongo-url", default=os.getenv('BENCHMARK_MONGO_URL', "mongodb://localhost:27017"))
+    parser.add_argument("--accounts", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--statements-per-day", type=int, default=100)
+    parser.add_argument("--deposits", type=int, default=5000)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--binance-port", type=int, default=8765)
+    parser.add_argument("--binance-latency", type=float, default=0, help="Delay of every fake Binance response in ms")
+    parser.add_argument("--compare", help="Results file of a previous run")
+    args = parser.parse_args()
+
+    result = asyncio.run(benchmark(args))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    file_name = os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'nogit'}.json")
+    with open(file_name, "w") as f:
+        json.dump(result, f, indent=2, default=str)
+    print(f"Results saved to {file_name}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
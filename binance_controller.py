@@ -1,90 +1,254 @@
-from binance.client import Client
-from mongo_controller import MongoController
-import requests
-import json
+from urllib.parse import urlencode
+from dotenv import load_dotenv
+from metrics import metrics
+import aiohttp
+import asyncio
 import hmac
 import hashlib
+import logging
+import random
 import time
-from dotenv import load_dotenv
 import os
 
+logger = logging.getLogger(__name__)
+
+
+class BinanceError(Exception):
+    """Raised when Binance answers a request with an error"""
+    def __init__(self, status, code=None, message=None):
+        self.status = status
+        self.code = code
+        self.message = message
+        super().__init__(f"Binance error {status} ({code}): {message}")
+
 
 class BinanceController:
-    def __init__(self):
-        self.controller = MongoController()
+    """Long lived asyncio Binance client, one instance is shared by the whole bot"""
+
+    # Headers in which Binance reports the request weight used in the current minute
+    WEIGHT_HEADERS = ("x-mbx-used-weight-1m", "x-sapi-used-ip-weight-1m")
+
+    def __init__(self, api_key=None, api_secret=None, base_url=None, timeout=10, max_retries=3, weight_limit=None, max_connections=20, symbols_ttl=3600, networks_ttl=900):
         load_dotenv()
-        self.api_key = os.getenv('API_KEY')
-        self.api_secret = os.getenv('SECRET_KEY')
-        self.client = Client(self.api_key, self.api_secret)
-        self.binance_url = "https://api4.binance.com"
-
-    def get_coin_networks(self, coin):
-        url = self.binance_url + "/sapi/v1/capital/config/getall"
-        # Create a timestamp
-        timestamp = int(time.time() * 1000)
-
-        # Create the signature
-        query_string = f"timestamp={timestamp}"
+        self.api_key = api_key or os.getenv('API_KEY')
+        self.api_secret = api_secret or os.getenv('SECRET_KEY')
+        self.binance_url = base_url or os.getenv('BINANCE_URL', "https://api4.binance.com")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.weight_limit = weight_limit or int(os.getenv('BINANCE_WEIGHT_LIMIT', 1000))
+        self.max_connections = max_connections
+        self.session = None
+        self.used_weight = 0
+        self.weight_window = 0
+        # Until when Binance refuses our requests after a 418/429, and the status it answered
+        self.banned_until = 0
+        self.ban_status = None
+        # (base asset, quote asset) -> symbol, refreshed in the background every symbols_ttl seconds
+        self.symbols_ttl = symbols_ttl
+        self.symbols = {}
+        self.symbols_updated = 0
+        self.symbols_lock = asyncio.Lock()
+        # coin -> {network: name}, same refresh strategy as the symbols
+        self.networks_ttl = networks_ttl
+        self.coin_networks = {}
+        self.coin_networks_updated = 0
+        self.coin_networks_lock = asyncio.Lock()
+        self.background_tasks = []
+
+    def _open_session(self):
+        """Opens the keep-alive connection pool"""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout), headers={"X-MBX-APIKEY": self.api_key})
+
+    async def start(self):
+        """Opens the connection pool and starts refreshing the cached exchange data"""
+        self._open_session()
+        if not self.background_tasks:
+            self.background_tasks.append(asyncio.create_task(self._refresh_loop(self.refresh_symbols, self.symbols_ttl)))
+            self.background_tasks.append(asyncio.create_task(self._refresh_loop(self.refresh_coin_networks, self.networks_ttl)))
+
+    async def _refresh_loop(self, refresh, interval):
+        """Calls refresh every interval seconds, the cached data is kept when a refresh fails"""
+        while True:
+            try:
+                await refresh()
+            except Exception:
+                logger.exception("Binance refresh %s failed, keeping the cached data", refresh.__name__)
+            await asyncio.sleep(max(interval, self.ban_remaining()))
+
+    async def close(self):
+        """Stops the background refreshes and closes the connection pool"""
+        for task in self.background_tasks:
+            task.cancel()
+        self.background_tasks = []
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _sign(self, params):
+        """Returns the signed query string for a request"""
+        params = dict(params)
+        params["timestamp"] = int(time.time() * 1000)
+        query_string = urlencode(params)
         signature = hmac.new(self.api_secret.encode('utf-8'), query_string.encode('utf-8'), hashlib.sha256).hexdigest()
+        return f"{query_string}&signature={signature}"
+
+    def _update_weight(self, headers):
+        """Keeps track of the weight Binance says we used in the current minute"""
+        for header in self.WEIGHT_HEADERS:
+            if header in headers:
+                self.used_weight = int(headers[header])
+                self.weight_window = int(time.time() // 60)
+                return
+
+    def ban_remaining(self):
+        """Returns the seconds until Binance accepts requests again, 0 if it isn't rate limiting us"""
+        return max(self.banned_until - time.time(), 0)
+
+    async def _wait_for_weight(self, weight):
+        """Waits until a request of weight can be sent without going over the limit"""
+        now = time.time()
+        if self.banned_until > now:
+            # A ban can last minutes to days, callers fail right away instead of outliving their interaction
+            # The background loops try again once it is over
+            raise BinanceError(self.ban_status, None, f"Rate limited by Binance for {int(self.banned_until - now)} more seconds")
+        if int(now // 60) != self.weight_window:
+            # New minute, Binance has reset the weight
+            self.used_weight = 0
+            self.weight_window = int(now // 60)
+        if self.used_weight + weight > self.weight_limit:
+            logger.warning("Binance weight %s/%s used, waiting for the next minute", self.used_weight, self.weight_limit)
+            await asyncio.sleep(60 - now % 60)
+            self.used_weight = 0
+            self.weight_window = int(time.time() // 60)
+        self.used_weight += weight
+
+    async def _request(self, method, path, params=None, signed=False, weight=1):
+        """Sends a request to Binance with retries, returns the decoded JSON"""
+        # Retries and waits for the weight limit are part of the latency of the call
+        with metrics.timer("binance", path):
+            return await self._send(method, path, params, signed, weight)
+
+    async def _send(self, method, path, params, signed, weight):
+        self._open_session()
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(2 ** attempt, 30) * 0.5 + random.random())
+            await self._wait_for_weight(weight)
+            query_string = self._sign(params or {}) if signed else urlencode(params or {})
+            url = f"{self.binance_url}{path}?{query_string}" if query_string else self.binance_url + path
+            try:
+                async with self.session.request(method, url) as response:
+                    self._update_weight(response.headers)
+                    if response.status in (418, 429):
+                        # Rate limited (429) or IP banned (418), stop sending until Binance allows it
+                        # The ban is recorded before the body is read, it may not be JSON when a proxy answers
+                        retry_after = response.headers.get("Retry-After", "")
+                        self.banned_until = time.time() + (int(retry_after) if retry_after.isdigit() else 60)
+                        self.ban_status = response.status
+                        data = await self._error_body(response)
+                        raise BinanceError(response.status, data.get("code"), data.get("msg"))
+                    data = await response.json(content_type=None)
+                    if response.status >= 500:
+                        last_error = BinanceError(response.status, None, str(data))
+                        continue
+                    if response.status >= 400:
+                        raise BinanceError(response.status, data.get("code"), data.get("msg"))
+                    return data
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                last_error = e
+        raise last_error
 
-        # Send the GET request
-        headers = { "X-MBX-APIKEY": self.api_key }
-        response = requests.get(url + "?" + query_string + "&signature=" + signature, headers=headers)
+    @staticmethod
+    async def _error_body(response):
+        """Returns the decoded body of an error response, {} if it isn't a JSON object"""
+        try:
+            data = await response.json(content_type=None)
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
 
-        # Parse the JSON response
-        response_json = json.loads(response.text)
+    async def refresh_coin_networks(self):
+        """Downloads the coin configuration and indexes the deposit networks of every coin"""
+        async with self.coin_networks_lock:
+            response_json = await self._request("GET", "/sapi/v1/capital/config/getall", signed=True, weight=10)
+            self.coin_networks = {
+                coin["coin"]: {network["network"]: network["name"] for network in coin["networkList"] if network.get("depositEnable", True)}
+                for coin in response_json
+            }
+            self.coin_networks_updated = time.time()
 
-        # Search json for coin = coin
-        coin_networks = {}
-        for i in range(len(response_json)):
-            if response_json[i]["coin"] == coin:
-                for j in range(len(response_json[i]["networkList"])):
-                    coin_networks[response_json[i]["networkList"][j]["network"]] = response_json[i]["networkList"][j]["name"]
-                break
-        
-        return coin_networks
+    async def get_coin_networks(self, coin):
+        """Returns the networks available for a specific cryptocurrency"""
+        if not self.coin_networks:
+            await self.refresh_coin_networks()
+        return self.coin_networks.get(coin, {})
 
-    def get_deposit_address(self, symbol, network=None):
+    async def get_deposit_address(self, symbol, network=None):
         """Returns the deposit address for a specific cryptocurrency"""
-        if network is None:
-            self.get_coin_networks(symbol)
-
-        return self.client.get_deposit_address(coin=symbol, network=network)
-    
-    def get_deposit_history(self, symbol):
-        """Returns the deposit history for a specific cryptocurrency"""
-        return self.client.get_deposit_history(coin=symbol)
-    
-    def get_deposit_by_txid(self, symbol, txid):
+        params = {"coin": symbol}
+        if network is not None:
+            params["network"] = network
+        return await self._request("GET", "/sapi/v1/capital/deposit/address", params, signed=True, weight=10)
+
+    async def get_deposit_history(self, symbol=None, start_time=None, txid=None, offset=0, limit=1000):
+        """Returns the deposit history, optionally for one cryptocurrency, since start_time (ms) or for one txid"""
+        params = {"offset": offset, "limit": limit}
+        if symbol is not None:
+            params["coin"] = symbol
+        if start_time is not None:
+            params["startTime"] = start_time
+        if txid is not None:
+            params["txId"] = txid
+        return await self._request("GET", "/sapi/v1/capital/deposit/hisrec", params, signed=True, weight=1)
+
+    async def get_deposit_by_txid(self, symbol, txid):
         """Check if the deposit with txid is in the deposit history"""
-        # Get deposit history
-        deposit_history = self.get_deposit_history(symbol)
         # Search for txid
-        for i in range(len(deposit_history)):
-            if deposit_history[i]["txId"] == txid:
-                return deposit_history[i]
+        for deposit in await self.get_deposit_history(symbol, txid=txid):
+            if deposit["txId"] == txid:
+                return deposit
         return None
-    
-    def get_coin_price_EUR(self, coin):
-        """Returns the price of a specific cryptocurrency"""
+
+    async def refresh_symbols(self):
+        """Downloads the exchange info and indexes the trading symbols by (base asset, quote asset)"""
+        async with self.symbols_lock:
+            exchange_info = await self._request("GET", "/api/v3/exchangeInfo", weight=20)
+            self.symbols = {(x["baseAsset"], x["quoteAsset"]): x["symbol"] for x in exchange_info["symbols"] if x["status"] == "TRADING"}
+            self.symbols_updated = time.time()
+
+    async def get_symbols(self):
+        """Returns the symbol index, it is only downloaded here if the background refresh hasn't run yet"""
+        if not self.symbols:
+            await self.refresh_symbols()
+        return self.symbols
+
+    async def get_coin_price_EUR(self, coin):
+        """Returns the price of one unit of a specific cryptocurrency in EUR"""
         currency = "EUR"
-        symbols = self.get_all_exchange_symbols()
+        symbols = await self.get_symbols()
 
-        # Find the symbol that contains the coin and the currency
-        for i in range(len(symbols)):
-            if coin in symbols[i] and currency in symbols[i]:
-                return self.client.get_symbol_ticker(symbol=symbols[i])["price"]
+        if (coin, currency) in symbols:
+            ticker = await self._request("GET", "/api/v3/ticker/price", {"symbol": symbols[(coin, currency)]}, weight=2)
+            return float(ticker["price"])
+        if (currency, coin) in symbols:
+            # Only the inverse pair is listed (e.g. EURUSDT)
+            ticker = await self._request("GET", "/api/v3/ticker/price", {"symbol": symbols[(currency, coin)]}, weight=2)
+            return 1 / float(ticker["price"])
 
         return None
 
-    def get_all_exchange_symbols(self):
+    async def get_all_exchange_symbols(self):
         """Returns all exchange symbols"""
-        return [x["symbol"] for x in self.client.get_exchange_info()["symbols"]]
+        return list((await self.get_symbols()).values())
 
-def main():
+async def main():
     binance_controller = BinanceController()
-    print(binance_controller.get_deposit_history("USDT"))
+    print(await binance_controller.get_deposit_history("USDT"))
+    await binance_controller.close()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
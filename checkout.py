@@ -0,0 +1,90 @@
+import discord
+import io
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+# This module contains the order fulfilment shared by /autocheckout and the payment matcher
+
+load_dotenv()
+# Relative difference allowed between the amount asked and the amount deposited (network fees, rounding)
+PAYMENT_TOLERANCE = float(os.getenv('PAYMENT_TOLERANCE', 0.005))
+# Checkout sessions are valid for 15 minutes
+CHECKOUT_WINDOW = timedelta(minutes=15)
+# Binance status of a deposit that has been credited
+DEPOSIT_SUCCESS = 1
+# Decimals of the crypto amounts asked to clients, the last ones make every open amount unique
+AMOUNT_DECIMALS = {"USDT": 4}
+DEFAULT_AMOUNT_DECIMALS = 8
+
+
+def amount_decimals(coin):
+    """Returns the number of decimals of the amounts asked in coin"""
+    return AMOUNT_DECIMALS.get(coin, DEFAULT_AMOUNT_DECIMALS)
+
+
+def deposit_time(deposit):
+    """Returns the time Binance received a deposit"""
+    return datetime.fromtimestamp(int(deposit['insertTime'])/1000)
+
+
+async def send_accounts(send, account_list):
+    """Sends accounts in a message, or in a file if there are 20 or more"""
+    if len(account_list) < 20:
+        await send("Here are your accounts: \n" + "```" +  "\n".join(account_list) + "```")
+    else:
+        await send(file=discord.File(fp=io.BytesIO("\n".join(account_list).encode("utf-8")), filename="accounts.txt"))
+
+
+async def fulfil_checkout(mongo, checkout_session, send):
+    """Sends the accounts of a paid checkout session and records the sale, returns False if there isn't enough stock"""
+    number_of_accounts = checkout_session['n_accounts']
+    client = checkout_session['user_id']
+    payment_method = checkout_session['coin']
+    total_price = checkout_session['total_price']
+    reserved_accounts = None
+    if checkout_session.get('held'):
+        # The accounts were put aside at /buy
+        reserved_accounts = await mongo.convert_hold(str(checkout_session['_id']), number_of_accounts)
+        if reserved_accounts is None:
+            # The hold was released in the meantime, give back what is left of it and take fresh stock
+            await mongo.release_accounts(str(checkout_session['_id']))
+    if reserved_accounts is None:
+        reserved_accounts = await mongo.reserve_accounts(number_of_accounts, str(checkout_session['_id']))
+    if reserved_accounts is None:
+        return False
+    account_list = [acc['account'] for acc in reserved_accounts]
+    await send_accounts(send, account_list)
+
+    # Create Finance statement
+    finance_statement = {
+        "Type": "Income",
+        "Product": "Account",
+        "Quantity": number_of_accounts,
+        "Unit_price": round(total_price / number_of_accounts,2),
+        "Total_Price": total_price,
+        "Payment_Method": payment_method,
+        "Client_id": client,
+        "Date": datetime.now()
+    }
+    await mongo.insert_finance_statement(finance_statement)
+
+    # Update client document
+    purchase = {
+        "Date": datetime.now(),
+        "Number_of_accounts": number_of_accounts,
+        "Total_price": total_price,
+        "Payment_method": payment_method,
+        "Account_list": account_list
+    }
+    # 1. Check if client exists
+    if await mongo.get_client(client) is not None:
+        # 2. Update client document
+        await mongo.add_new_client_purchase(client, purchase)
+    else:
+        # 3. Create client document
+        await mongo.insert_new_client(client, datetime.now(), 0, [purchase], [], [], 0)
+
+    # Update checkout session status to completed
+    await mongo.complete_checkout_session(checkout_session['_id'])
+    return True
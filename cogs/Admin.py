@@ -2,17 +2,22 @@ import discord
 import logging
 from discord.ext import commands
 from discord import app_commands
-from mongo_controller import MongoController
-from datetime import datetime
-import os
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from account_importer import import_accounts_async, iter_lines
+from account_exporter import UPLOAD_LIMIT, export_accounts
+from checkout import send_accounts
+from metrics import metrics
+import io
 
 class Admin(commands.Cog):
     def __init__(self, client):
         self.client = client
+        self.mongo = client.mongo
 
     async def log(self, member: discord.Member, action: str):
-        channel = self.client.get_channel(1073219018586066944)
-        await channel.send(f"```[{member}] -> [{action}]```")   
+        # Queued, the audit logger sends it in the background
+        self.client.audit.log(member, action)
 
     async def payment_method_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
         payment_methods = ['USDT', 'LTC', 'BTC', 'ETH', 'Revolut', 'Binance Pay ID']
@@ -27,23 +32,17 @@ class Admin(commands.Cog):
     async def gen(self, interaction: discord.Interaction, number_of_accounts: int, client: str, total_price: float, payment_method: str):
         # Log command
         await self.log(interaction.user, f'{str(interaction.command.name)} {number_of_accounts} {client} {total_price} {payment_method}')
-        account_list = [acc['account'] for acc in MongoController().get_n_available_accounts(number_of_accounts)]
         # Defer
         await interaction.response.defer()
+        # The stock counter turns down orders it can't fill without asking the database
+        if not self.mongo.stock.has(number_of_accounts):
+            return await interaction.followup.send("Not enough accounts in stock")
+        reserved_accounts = await self.mongo.reserve_accounts(number_of_accounts, str(ObjectId()))
         
-        if len(account_list) == number_of_accounts:
-            # Send accs in string if number_of_accounts is < 20
-            if number_of_accounts < 20:
-                await interaction.followup.send("Here are your accounts: \n" + "```" +  "\n".join(account_list) + "```")
-            else:
-                # Send accs in file if number_of_accounts is >= 20
-                with open("accounts.txt", "w") as f:
-                    f.write("Here are your accounts: \n" + "\n".join(account_list))
-                await interaction.followup.send(file=discord.File(fp="accounts.txt", filename="accounts.txt"))
-                os.remove("accounts.txt")
-            # Update accounts in database to status = sold
-            for acc in account_list:
-                MongoController().update_account_status(acc, "sold")
+        if reserved_accounts is not None:
+            account_list = [acc['account'] for acc in reserved_accounts]
+            # In a message, or in an in-memory file from 20 accounts, concurrent orders never share a file
+            await send_accounts(interaction.followup.send, account_list)
             # Create Finance statement
             finance_statement = {
                 "Type": "Income",
@@ -55,11 +54,11 @@ class Admin(commands.Cog):
                 "Client_id": client.strip("<@>"),
                 "Date": datetime.now()
             }
-            MongoController().insert_finance_statement(finance_statement)
+            await self.mongo.insert_finance_statement(finance_statement)
 
             # Update client document
             # 1. Check if client exists
-            if MongoController().get_client(client.strip("<@>")) is not None:
+            if await self.mongo.get_client(client.strip("<@>")) is not None:
                 # 2. Update client document
                 purchase = {
                     "Date": datetime.now(),
@@ -68,7 +67,7 @@ class Admin(commands.Cog):
                     "Payment_method": payment_method,
                     "Account_list": account_list
                 }
-                MongoController().add_new_client_purchase(client.strip("<@>"), purchase)
+                await self.mongo.add_new_client_purchase(client.strip("<@>"), purchase)
             else:
                 # 3. Create client document
                 account_purchases = [{
@@ -78,7 +77,7 @@ class Admin(commands.Cog):
                     "Payment_method": payment_method,
                     "Account_list": account_list
                 }]
-                MongoController().insert_new_client(client.strip("<@>"), datetime.now(), 0, account_purchases, [], [], 0)
+                await self.mongo.insert_new_client(client.strip("<@>"), datetime.now(), 0, account_purchases, [], [], 0)
 
                 # Add Client role if not already added
                 # Get member from client ID
@@ -97,29 +96,23 @@ class Admin(commands.Cog):
     async def replace(self, interaction: discord.Interaction, number_of_accounts: int, client: str):
         # Log command
         await self.log(interaction.user, f'{str(interaction.command.name)} {number_of_accounts} {client}')
-        account_list = [acc['account'] for acc in MongoController().get_n_available_accounts(number_of_accounts)]
-        if len(account_list) == number_of_accounts:
-            if number_of_accounts < 20:
-                await interaction.response.send_message("Here are your accounts: \n" + "```" +  "\n".join(account_list) + "```")
-            else:
-                # Send accs in file if number_of_accounts is >= 20
-                with open("accounts.txt", "w") as f:
-                    f.write("Here are your accounts: \n" + "\n".join(account_list))
-                await interaction.response.send_message(file=discord.File(fp="accounts.txt", filename="accounts.txt"))
-                os.remove("accounts.txt")
-            # Update accounts in database to status = sold
-            for acc in account_list:
-                MongoController().update_account_status(acc, "sold")
+        if not self.mongo.stock.has(number_of_accounts):
+            return await interaction.response.send_message("Not enough accounts in stock")
+        reserved_accounts = await self.mongo.reserve_accounts(number_of_accounts, str(ObjectId()))
+        if reserved_accounts is not None:
+            account_list = [acc['account'] for acc in reserved_accounts]
+            # In a message, or in an in-memory file from 20 accounts, concurrent orders never share a file
+            await send_accounts(interaction.response.send_message, account_list)
             # Update client document
             # 1. Check if client exists
-            if MongoController().get_client(client.strip("<@>")) is not None:
+            if await self.mongo.get_client(client.strip("<@>")) is not None:
                 # 2. Update client document
                 replacement = {
                     "Date": datetime.now(),
                     "Number_of_accounts": number_of_accounts,
                     "Account_list": account_list
                 }
-                MongoController().add_new_client_replacement(client.strip("<@>"), replacement)
+                await self.mongo.add_new_client_replacement(client.strip("<@>"), replacement)
             else:
                 # 3. Create client document
                 replacement = [{
@@ -127,7 +120,7 @@ class Admin(commands.Cog):
                     "Number_of_accounts": number_of_accounts,
                     "Account_list": account_list
                 }]
-                MongoController().insert_new_client(client.strip("<@>"), datetime.now(), 0, [], replacement, [], 0)
+                await self.mongo.insert_new_client(client.strip("<@>"), datetime.now(), 0, [], replacement, [], 0)
         else:
             await interaction.response.send_message("Not enough accounts in stock")
             return
@@ -145,78 +138,115 @@ class Admin(commands.Cog):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name} {status} {file.filename}')
         await interaction.response.defer()
-        f = await file.read()
-        # Convert bytes to string
-        f = f.decode("utf-8").split('\n')
-        for account in f:
-            # Check if account already exists
-            if MongoController().get_account(account) is None:
-                # If not, insert it
-                MongoController().insertOne_account(account, status)
-            else:
-                # If it does, update it
-                MongoController().update_account_status(account, status)
-        return await interaction.followup.send("Accounts imported successfully")
+        data = await file.read()
+
+        async def progress(summary):
+            await interaction.edit_original_response(content=f"Importing... {summary['total']} lines read, {summary['inserted']} inserted, {summary['updated']} updated")
+
+        summary = await import_accounts_async(self.mongo, iter_lines(data), status, progress=progress)
+        return await interaction.followup.send(f"Accounts imported successfully: **{summary['inserted']}** inserted, **{summary['updated']}** updated, **{summary['skipped']}** skipped")
     
+    async def export(self, interaction: discord.Interaction, name: str, status: str = None, since: str = None, until: str = None, compress: bool = False):
+        """Streams accounts into as many attachments as the server's upload limit needs"""
+        await interaction.response.defer()
+        since = datetime.strptime(since, '%d/%m/%Y') if since else None
+        # The until day is included
+        until = datetime.strptime(until, '%d/%m/%Y') + timedelta(days=1) if until else None
+        upload_limit = interaction.guild.filesize_limit if interaction.guild is not None else UPLOAD_LIMIT
+
+        async def send(filename, buffer):
+            await interaction.followup.send(file=discord.File(fp=buffer, filename=filename))
+
+        summary = await export_accounts(self.mongo, name, send, status, since, until, compress, upload_limit)
+        return await interaction.followup.send(f"Exported **{summary['accounts']}** accounts in **{summary['parts']}** file(s)")
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.autocomplete(status=account_status_autocomplete)
+    @app_commands.command(name="export_accounts", description="Export accounts by status and import date (dd/mm/yyyy)")
+    async def export_accounts(self, interaction: discord.Interaction, status: str = None, since: str = None, until: str = None, compress: bool = False):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {status} {since} {until} {compress}')
+        return await self.export(interaction, f"{status or 'all'}_accounts", status, since, until, compress)
+
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="export_sold_accounts", description="Export sold accounts")
-    async def export_sold_accounts(self, interaction: discord.Interaction):
+    async def export_sold_accounts(self, interaction: discord.Interaction, since: str = None, until: str = None, compress: bool = False):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name}')
-        account_list = [acc['account'] for acc in MongoController().get_all_sold_accounts()]
-        with open("sold_accounts.txt", "w") as f:
-            f.write("\n".join(account_list))
-        await interaction.response.send_message(file=discord.File(fp="sold_accounts.txt", filename="sold_accounts.txt"))
-        return os.remove("sold_accounts.txt")
-    
+        return await self.export(interaction, "sold_accounts", "sold", since, until, compress)
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="export_all_accounts", description="Export all accounts")
-    async def export_all_accounts(self, interaction: discord.Interaction):
+    async def export_all_accounts(self, interaction: discord.Interaction, since: str = None, until: str = None, compress: bool = False):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name}')
-        account_list = [acc['account'] for acc in MongoController().get_all_accounts()]
-        with open("all_accounts.txt", "w") as f:
-            f.write("\n".join(account_list))
-        await interaction.response.send_message(file=discord.File(fp="all_accounts.txt", filename="all_accounts.txt"))
-        return os.remove("all_accounts.txt")
-    
-    
+        return await self.export(interaction, "all_accounts", None, since, until, compress)
+
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="export_cartable_accounts", description="Export cartable accounts")
-    async def export_cartable_accounts(self, interaction: discord.Interaction):
+    async def export_cartable_accounts(self, interaction: discord.Interaction, since: str = None, until: str = None, compress: bool = False):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name}')
-        account_list = [acc['account'] for acc in MongoController().get_all_cartable_accounts()]
-        with open("cartable_accounts.txt", "w") as f:
-            f.write("\n".join(account_list))
-        await interaction.response.send_message(file=discord.File(fp="cartable_accounts.txt", filename="cartable_accounts.txt"))
-        return os.remove("cartable_accounts.txt")
-    
+        return await self.export(interaction, "cartable_accounts", "cartable", since, until, compress)
 
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="finance", description="Shows finance results")
     async def finance(self, interaction: discord.Interaction, start_date: str, end_date: str):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name} {start_date} {end_date}')
-        revenue, expenses, profit, profit_margin, n_accounts_sold = MongoController().basic_finance_dashboard(datetime.strptime(start_date, '%d/%m/%Y'), datetime.strptime(end_date, '%d/%m/%Y'))
+        revenue, expenses, withdrawals, profit, profit_margin, n_accounts_sold = await self.mongo.basic_finance_dashboard(datetime.strptime(start_date, '%d/%m/%Y'), datetime.strptime(end_date, '%d/%m/%Y'))
         embed = discord.Embed(title="Finance Dashboard", description=f"From {start_date} to {end_date}", color=0xff9a00)
         embed.add_field(name="Revenue", value=f"{round(revenue['total'],2)} €", inline=False)
         embed.add_field(name="Expenses", value=f"{round(expenses['total'],2)} €", inline=False)
         embed.add_field(name="Profit", value=f"{round(profit['total'],2)} €", inline=False)
-        embed.add_field(name="Profit Margin", value=f"{round(profit_margin,2)} %", inline=False)
+        embed.add_field(name="Profit Margin", value=f"{profit_margin} %", inline=False)
+        embed.add_field(name="Withdrawals", value=f"{round(withdrawals['total'],2)} €", inline=False)
         embed.add_field(name="Number of accounts sold", value=f"{n_accounts_sold}", inline=False)
-        embed.add_field(name="Average selling price per account", value=f"{round(revenue['total'] / n_accounts_sold, 2)} €", inline=False)
-        embed.add_field(name="Average cost per account", value=f"{round(expenses['total'] / n_accounts_sold, 2)} €\n", inline=False)
+        if n_accounts_sold != 0:
+            embed.add_field(name="Average selling price per account", value=f"{round(revenue['total'] / n_accounts_sold, 2)} €", inline=False)
+            embed.add_field(name="Average cost per account", value=f"{round(expenses['total'] / n_accounts_sold, 2)} €\n", inline=False)
         embed1 = discord.Embed(title="Details per payment method", description="\u200b", color=0xff9a00)
-        for key in revenue.keys():
+        for key in profit.keys():
             if key != "total":
-                embed1.add_field(name=f"Revenue {key}", value=f"{round(revenue[key],2)} €", inline=True)
-                embed1.add_field(name=f"Expenses {key}", value=f"{round(expenses[key],2) if key in expenses else 0} €", inline=True)
+                embed1.add_field(name=f"Revenue {key}", value=f"{round(revenue.get(key, 0),2)} €", inline=True)
+                embed1.add_field(name=f"Expenses {key}", value=f"{round(expenses.get(key, 0),2)} €", inline=True)
                 embed1.add_field(name=f"Profit {key}", value=f"{round(profit[key],2)} €", inline=True)
         embed1.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
         return await interaction.response.send_message(embeds=[embed, embed1])
-        
+
+    async def granularity_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        granularities = ['day', 'week', 'month']
+        return [
+            app_commands.Choice(name=granularity, value=granularity)
+            for granularity in granularities if current.lower() in granularity.lower()
+        ]
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.autocomplete(granularity=granularity_autocomplete)
+    @app_commands.command(name="finance_report", description="Shows finance results per day, week or month")
+    async def finance_report(self, interaction: discord.Interaction, start_date: str, end_date: str, granularity: str = "week"):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {start_date} {end_date} {granularity}')
+        if granularity not in ('day', 'week', 'month'):
+            return await interaction.response.send_message("Granularity must be day, week or month", ephemeral=True)
+        series = await self.mongo.finance_timeseries(datetime.strptime(start_date, '%d/%m/%Y'), datetime.strptime(end_date, '%d/%m/%Y'), granularity)
+        lines = [f"**{row['period'].strftime('%d/%m/%Y')}** | Revenue {round(row['revenue'],2)} € | Expenses {round(row['expenses'],2)} € | Profit {round(row['profit'],2)} € | {row['n_accounts_sold']} accs" for row in series]
+        description = "\n".join(lines) if lines else "No statements in this period"
+        if len(description) > 4096:
+            description = description[:4000].rsplit("\n", 1)[0] + "\n..."
+        embed = discord.Embed(title=f"Finance Report per {granularity}", description=description, color=0xff9a00)
+        embed.set_footer(text=f"From {start_date} to {end_date} | Requested by {interaction.user.name}")
+        return await interaction.response.send_message(embed=embed)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="rebuild_finance_rollups", description="Rebuilds the daily finance rollups from all statements")
+    async def rebuild_finance_rollups(self, interaction: discord.Interaction):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name}')
+        await interaction.response.defer()
+        n_rollups = await self.mongo.rebuild_finance_rollups()
+        return await interaction.followup.send(f"Finance rollups rebuilt: **{n_rollups}** daily rollups")
+
         
     async def statement_type_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
         statement_types = ['Income', 'Expense', 'Withdraw']
@@ -241,7 +271,7 @@ class Admin(commands.Cog):
             "Client_id": str(interaction.user.id),
             "Date": datetime.now(),
         }
-        MongoController().insert_finance_statement(finance_statement)
+        await self.mongo.insert_finance_statement(finance_statement)
         return await interaction.response.send_message("Statement inserted successfully")
     
     @app_commands.command(name="stock", description="Shows the amount of accounts in stock")
@@ -255,8 +285,24 @@ class Admin(commands.Cog):
                 pass
             else:
                 return await interaction.response.send_message("You can only use this command in a ticket channel")
-        n_accounts = MongoController().get_number_of_available_accounts()
+        # Read from the in-memory stock counter, the database is only asked before it is loaded
+        n_accounts = self.mongo.stock.get("cartable") if self.mongo.stock.loaded else await self.mongo.get_number_of_available_accounts()
         return await interaction.response.send_message(f"There are **{n_accounts}** accounts in stock")
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="stock_breakdown", description="Shows the amount of accounts of every status")
+    async def stock_breakdown(self, interaction: discord.Interaction, recount: bool = False):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {recount}')
+        await interaction.response.defer()
+        drift = await self.mongo.reconcile_stock() if recount or not self.mongo.stock.loaded else {}
+        embed = discord.Embed(title="Stock", description="", color=0xff9a00)
+        for status, n_accounts in self.mongo.stock.breakdown().items():
+            embed.add_field(name=status.replace("_", " ").capitalize(), value=f"{n_accounts}", inline=True)
+        if drift:
+            embed.add_field(name="Corrected", value="\n".join(f"{status}: {n:+}" for status, n in drift.items()), inline=False)
+        embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.followup.send(embed=embed)
     
 
     @app_commands.checks.has_permissions(administrator=True)
@@ -264,12 +310,15 @@ class Admin(commands.Cog):
     async def prices(self, interaction: discord.Interaction):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name}')
-        prices = MongoController().get_account_prices()
+        ladder = await self.mongo.get_price_ladder()
         embed = discord.Embed(title="Prices", description="", color=0xff9a00)
-        steps = [list(step.values())[0] for step in prices]
-        for i in range(len(steps)-1):
-            embed.add_field(name="\u200b", value=f"{steps[i]}-{steps[i+1]}: **{list(prices[i].values())[1]}€**", inline=False)
-        embed.add_field(name="\u200b", value=f"{steps[-1]}+: **{list(prices[-1].values())[1]}€** (negotiable)", inline=False)
+        # Price of buying the first quantity of every tier
+        quotes = ladder.quotes(ladder.steps)
+        for step, next_step, price in ladder.tiers():
+            if next_step is not None:
+                embed.add_field(name="\u200b", value=f"{step}-{next_step}: **{price}€** ({step} accounts = {quotes[step]}€)", inline=False)
+            else:
+                embed.add_field(name="\u200b", value=f"{step}+: **{price}€** (negotiable)", inline=False)
         # TODO: Add link to create ticket channel
 
         embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
@@ -281,7 +330,7 @@ class Admin(commands.Cog):
     async def set_price(self, interaction: discord.Interaction, step: int, price: float):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name} {step} {price}')
-        MongoController().set_account_price(step, price)
+        await self.mongo.set_account_price(step, price)
         return await interaction.response.send_message(f"Price for step {step} set to {price}€")
     
     @app_commands.checks.has_permissions(administrator=True)
@@ -289,17 +338,41 @@ class Admin(commands.Cog):
     async def remove_price(self, interaction: discord.Interaction, step: int):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name} {step}')
-        MongoController().del_account_price(step)
+        await self.mongo.del_account_price(step)
         return await interaction.response.send_message(f"Price for step {step} removed")
-    
+
+    async def leaderboard_metric_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        metrics = ['revenue', 'accounts', 'replacements']
+        return [
+            app_commands.Choice(name=metric, value=metric)
+            for metric in metrics if current.lower() in metric.lower()
+        ]
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.autocomplete(metric=leaderboard_metric_autocomplete)
+    @app_commands.command(name="leaderboard", description="Shows the top clients by revenue, accounts bought or replacements")
+    async def leaderboard(self, interaction: discord.Interaction, metric: str = "revenue", top: app_commands.Range[int, 1, 25] = 10):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {metric} {top}')
+        if metric not in ('revenue', 'accounts', 'replacements'):
+            return await interaction.response.send_message("Metric must be revenue, accounts or replacements", ephemeral=True)
+        leaderboard = await self.mongo.get_client_leaderboard(metric, top)
+        lines = [f"**{i+1}.** <@{row['client_id']}> - {round(row['value'],2)}{' €' if metric == 'revenue' else ''}" for i, row in enumerate(leaderboard)]
+        embed = discord.Embed(title=f"Leaderboard by {metric}", description="\n".join(lines) if lines else "No clients yet", color=0xff9a00)
+        embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.response.send_message(embed=embed)
+
     @app_commands.checks.has_permissions(administrator=True)
     @app_commands.command(name="client_profile", description="Sends client profile")
     async def client_profile(self, interaction: discord.Interaction, member: discord.Member):
         # Log Command
         await self.log(interaction.user, f'{interaction.command.name} {member.name}')
-        total_number_of_accounts_bought = MongoController().get_client_number_of_account_purchases(str(member.id))
-        total_number_replacements = MongoController().get_client_number_of_replacements(str(member.id))
-        revenue = MongoController().get_client_revenue(str(member.id))
+        profile = await self.mongo.get_client_profile(str(member.id))
+        if profile == None:
+            return await interaction.response.send_message(f"{member.name} is not a client", ephemeral=True)
+        total_number_of_accounts_bought = profile.get("total_accounts", 0)
+        total_number_replacements = profile.get("total_replacements", 0)
+        revenue = profile.get("total_revenue", 0)
         #TODO: Implement Services
 
         embed = discord.Embed(title=f"Client Profile", description="", color=0xff9a00)
@@ -308,11 +381,98 @@ class Admin(commands.Cog):
         embed.add_field(name="Total accounts bought", value=f"{total_number_of_accounts_bought}", inline=True)
         embed.add_field(name="Total replacements", value=f"{total_number_replacements}", inline=True)
         embed.add_field(name="Revenue", value=f"{round(revenue,2)}€", inline=True)
-        embed.add_field(name="Avg price per account", value=f"{round(revenue/total_number_of_accounts_bought,2)}€", inline=True)
-        embed.add_field(name="Estimate of profit", value=f"{round(((revenue/(total_number_of_accounts_bought+total_number_replacements))-1)*total_number_of_accounts_bought,2)}€", inline=True)
+        if total_number_of_accounts_bought != 0:
+            embed.add_field(name="Avg price per account", value=f"{round(revenue/total_number_of_accounts_bought,2)}€", inline=True)
+            embed.add_field(name="Estimate of profit", value=f"{round(((revenue/(total_number_of_accounts_bought+total_number_replacements))-1)*total_number_of_accounts_bought,2)}€", inline=True)
         embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
 
         return await interaction.response.send_message(embed=embed)
 
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="migrate_purchases", description="Moves the purchase history of every client to the Purchases collection and recomputes their totals")
+    async def migrate_purchases(self, interaction: discord.Interaction):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name}')
+        await interaction.response.defer()
+        n_clients, n_purchases = await self.mongo.migrate_client_purchases()
+        # Counters are recomputed from the migrated history, never before the arrays are moved
+        n_counters = await self.mongo.backfill_client_counters()
+        return await interaction.followup.send(f"Migrated **{n_purchases}** purchases of **{n_clients}** clients, client counters updated for **{n_counters}** clients")
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="client_history", description="Shows the purchase history of a client")
+    @app_commands.choices(purchase_type=[
+        app_commands.Choice(name="Account purchases", value="account_purchase"),
+        app_commands.Choice(name="Replacements", value="replacement"),
+        app_commands.Choice(name="Services", value="service"),
+    ])
+    async def client_history(self, interaction: discord.Interaction, member: discord.Member, purchase_type: app_commands.Choice[str] = None, page: int = 1):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {member} {page}')
+        purchase_type = purchase_type.value if purchase_type is not None else None
+        page = max(page, 1)
+        history = await self.mongo.get_client_history(str(member.id), purchase_type, page - 1)
+        total = await self.mongo.count_client_history(str(member.id), purchase_type)
+        embed = discord.Embed(title=f"Purchase History", description=f"{member.name}", color=0xff9a00)
+        for purchase in history:
+            details = f"{purchase.get('Number_of_accounts', 0)} accounts"
+            if "Total_price" in purchase:
+                details += f" | {round(purchase['Total_price'],2)}€"
+            embed.add_field(name=f"{purchase['Type'].replace('_', ' ').capitalize()} - {purchase['Date'].strftime('%d/%m/%Y %H:%M')}", value=details, inline=False)
+        if not history:
+            embed.description += "\nNo purchases found"
+        embed.set_footer(text=f"Page {page}/{max((total + 9) // 10, 1)} | Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.response.send_message(embed=embed)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="index_report", description="Checks the database indexes and the query plans of the hot queries")
+    async def index_report(self, interaction: discord.Interaction):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name}')
+        await interaction.response.defer()
+        errors = await self.mongo.create_indexes()
+        missing = await self.mongo.missing_indexes()
+        report = await self.mongo.explain_hot_queries()
+        embed = discord.Embed(title="Index Report", description="", color=0xff9a00)
+        embed.add_field(name="Missing indexes", value="\n".join(f"{index['collection']} {index['index']}" for index in missing) or "None", inline=False)
+        if errors:
+            embed.add_field(name="Errors", value="\n".join(f"{error['collection']} {error['index']}: {error['error'][:100]}" for error in errors)[:1024], inline=False)
+        lines = [f"{'⚠️' if query['collscan'] else '✅'} {query['name']} ({query['collection']}): {' < '.join(query['stages'])}" for query in report]
+        embed.add_field(name="Query plans", value="\n".join(lines)[:1024], inline=False)
+        embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.followup.send(embed=embed)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.choices(kind=[
+        app_commands.Choice(name="Commands", value="command"),
+        app_commands.Choice(name="Buttons and menus", value="ui"),
+        app_commands.Choice(name="Database", value="mongo"),
+        app_commands.Choice(name="Binance", value="binance"),
+    ])
+    @app_commands.command(name="metrics", description="Shows the latency of commands, callbacks and backend calls")
+    async def show_metrics(self, interaction: discord.Interaction, kind: app_commands.Choice[str] = None, prometheus: bool = False):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name} {kind.value if kind else None} {prometheus}')
+        if prometheus:
+            return await interaction.response.send_message(file=discord.File(fp=io.BytesIO(metrics.render_prometheus().encode("utf-8")), filename="metrics.prom"))
+        rows = metrics.summary(kind.value if kind is not None else None)[:20]
+        embed = discord.Embed(title="Metrics", description="Slowest by total time" if rows else "No calls recorded yet", color=0xff9a00)
+        for row in rows:
+            embed.add_field(name=f"{row['kind']} {row['name']}"[:256], value=f"{row['count']} calls ({row['errors']} errors) | {row['rate']*60:.2f}/min\np50 {row['p50']*1000:.0f} ms | p99 {row['p99']*1000:.0f} ms", inline=False)
+        embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.response.send_message(embed=embed)
+
+    @app_commands.checks.has_permissions(administrator=True)
+    @app_commands.command(name="pool_stats", description="Shows database connection pool statistics")
+    async def pool_stats(self, interaction: discord.Interaction):
+        # Log Command
+        await self.log(interaction.user, f'{interaction.command.name}')
+        stats = self.mongo.get_pool_stats()
+        embed = discord.Embed(title="Database Pool", description="", color=0xff9a00)
+        for key, value in stats.items():
+            embed.add_field(name=key.replace("_", " ").capitalize(), value=f"{value}", inline=True)
+        embed.set_footer(text=f"Requested by {interaction.user.name} | {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}")
+        return await interaction.response.send_message(embed=embed)
+
 async def setup(client:commands.Bot):
     await client.add_cog(Admin(client))
\ No newline at end of file
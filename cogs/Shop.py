@@ -2,24 +2,25 @@ import discord
 import logging
 from discord.ext import commands
 from discord import app_commands
-from mongo_controller import MongoController
-from binance_controller import BinanceController
-from datetime import datetime
-import os
+from metrics import metrics
+from checkout import DEPOSIT_SUCCESS, PAYMENT_TOLERANCE, amount_decimals, deposit_time, fulfil_checkout
 
 class Shop(commands.Cog):
     def __init__(self, client):
         self.client = client
+        self.mongo = client.mongo
+        self.binance = client.binance
+        self.deposits = client.deposits
 
     async def log(self, member: discord.Member, action: str):
-        channel = self.client.get_channel(1073219018586066944)
-        await channel.send(f"```[{member}] -> [{action}]```")
+        # Queued, the audit logger sends it in the background
+        self.client.audit.log(member, action)
     
     @app_commands.command(name="address", description="Select menu for payment addresses")
     async def address(self, interaction: discord.Interaction):
         # Log command
         await self.log(interaction.user, interaction.command.name)
-        view = SelectAddressInfoView()
+        view = SelectAddressInfoView(self.mongo, self.binance)
         await interaction.response.send_message("Select payment option", view=view)
 
 
@@ -31,100 +32,57 @@ class Shop(commands.Cog):
         # Get interaction channel
         channel = interaction.channel.name
         if "ticket" in channel:
-            # Check if user has a checkout session
-            checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))
-            if checkout_session == [] or checkout_session == None:
-                # Create new checkout session
-                MongoController().create_new_checkout_session(str(interaction.user.id), int(number_of_accounts))
-            else:
+            # Don't let clients pay for accounts that aren't in stock
+            if not self.mongo.stock.has(int(number_of_accounts)):
+                return await interaction.response.send_message("There are not enough accounts in stock, check `/stock`", ephemeral=True)
+            # Create new checkout session, unless the user already has one
+            checkout_session, created = await self.mongo.open_checkout_session(str(interaction.user.id), int(number_of_accounts))
+            if not created:
                 # User can't have more than one checkout session
                 return await interaction.response.send_message("You already have a checkout session", ephemeral=True)
-            await interaction.response.send_message(embed=discord.Embed(title = f"Checking out {number_of_accounts} accounts", description="Select payment method to get the address.", color = discord.Colour.orange()).add_field(name="More Information", value="If you pay with **USDT** you will be able to **instantly checkout**.\n Cancel your checkout anytime.\nCheckout is valid for **15 minutes**."), view=SelectAddressView("buy"))
+            # The accounts are put aside until the session is paid or expires
+            if not await self.mongo.hold_checkout_session(checkout_session):
+                await self.mongo.cancel_checkout_session(checkout_session['_id'], str(interaction.user.id))
+                return await interaction.response.send_message("There are not enough accounts in stock, check `/stock`", ephemeral=True)
+            checkout_session['held'] = True
+            self.client.holds.schedule(checkout_session)
+            # The views carry the session so the next steps don't look it up again
+            await interaction.response.send_message(embed=discord.Embed(title = f"Checking out {number_of_accounts} accounts", description="Select payment method to get the address.", color = discord.Colour.orange()).add_field(name="More Information", value="Your accounts are reserved for you until the checkout expires.\nIf you pay with **crypto** your accounts are sent **automatically** once the payment arrives.\n Cancel your checkout anytime.\nCheckout is valid for **15 minutes**."), view=SelectAddressView(self.mongo, self.binance, "buy", checkout_session))
 
         else:
             await interaction.response.send_message("This command can only be used in a ticket channel", ephemeral=True)
 
-    @app_commands.command(name="autocheckout", description="Autocheckout with Txid - USDT payments only")
+    @app_commands.command(name="autocheckout", description="Autocheckout with Txid - crypto payments only")
     async def autocheckout(self, interaction: discord.Interaction, txid: str):
         # Log command
         await self.log(interaction.user, f'{interaction.command.name} {txid}')
         # Check if user has a checkout session
-        checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))
+        # A session that expired while its deposit was confirming can still be paid
+        checkout_session = await self.mongo.get_payable_checkout_session_by_user_id(str(interaction.user.id))
         if checkout_session == [] or checkout_session == None:
             return await interaction.response.send_message("You don't have a checkout session", ephemeral=True)
-        elif checkout_session['status'] == "pending" and checkout_session['coin'] == 'USDT':
-            # Check if txid exists 
-            if BinanceController().get_deposit_by_txid("USDT", txid) != None:
-                # Check if amount is correct
-                if float(BinanceController().get_deposit_by_txid("USDT", txid)['amount']) >= int(checkout_session['total_price']):
-                    # Check if date is correct
-                    if datetime.fromtimestamp(int(BinanceController().get_deposit_by_txid("USDT", txid)['insertTime'])/1000) >= checkout_session['createdAt']:
-                        # Send n_accounts
-                        # Send accs in string if number_of_accounts is < 20
-                        MongoController().set_session_txid(str(interaction.user.id), txid)
-                        number_of_accounts = checkout_session['n_accounts']
-                        client = checkout_session['user_id']
-                        payment_method = checkout_session['coin']
-                        total_price = checkout_session['total_price']
-                        account_list = [acc['account'] for acc in MongoController().get_n_available_accounts(number_of_accounts)]
-                        if len(account_list) != number_of_accounts:
-                            return await interaction.response.send_message("There are not enough accounts available.\n For further support ping a Moderator", ephemeral=True)
-                        if number_of_accounts < 20:
-                            await interaction.response.send_message("Here are your accounts: \n" + "```" +  "\n".join(account_list) + "```")
-                        else:
-                            # Send accs in file if number_of_accounts is >= 20
-                            with open("accounts.txt", "w") as f:
-                                f.write("\n".join(account_list))
-                            await interaction.response.send_message(file=discord.File(fp="accounts.txt", filename="accounts.txt"))
-                            os.remove("accounts.txt")
-                        # Update accounts in database to status = sold
-                        for acc in account_list:
-                            MongoController().update_account_status(acc, "sold")
-                        # Create Finance statement
-                        finance_statement = {
-                            "Type": "Income",
-                            "Product": "Account",
-                            "Quantity": number_of_accounts,
-                            "Unit_price": round(total_price / number_of_accounts,2),
-                            "Total_Price": total_price,
-                            "Payment_Method": payment_method,
-                            "Client_id": client,
-                            "Date": datetime.now()
-                        }
-                        MongoController().insert_finance_statement(finance_statement)
-
-                        # Update client document
-                        # 1. Check if client exists
-                        if MongoController().get_client(client) is not None:
-                            # 2. Update client document
-                            purchase = {
-                                "Date": datetime.now(),
-                                "Number_of_accounts": number_of_accounts,
-                                "Total_price": total_price,
-                                "Payment_method": payment_method,
-                                "Account_list": account_list
-                            }
-                            MongoController().add_new_client_purchase(client, purchase)
-                        else:
-                            # 3. Create client document
-                            account_purchases = [{
-                                "Date": datetime.now(),
-                                "Number_of_accounts": number_of_accounts,
-                                "Total_price": total_price,
-                                "Payment_method": payment_method,
-                                "Account_list": account_list
-                            }]
-                            MongoController().insert_new_client(client.strip("<@>"), datetime.now(), 0, account_purchases, [], [], 0)
-
-                        # Update checkout session status to completed
-                        MongoController().set_session_status(checkout_session['_id'], "completed")
-                    else:
-                        await interaction.response.send_message(f"Transaction date is older than checkout session", ephemeral=True)
-                else:
-                    await interaction.response.send_message(f"Amount is not correct: {BinanceController().get_deposit_by_txid('USDT', txid)['amount']} ≠ {checkout_session['total_price']}", ephemeral=True)
-            else:
-                await interaction.response.send_message("Txid does not exist", ephemeral=True)
-        return await interaction.response.send_message("Error, most likely your checkout has a coin different than USDT", ephemeral=True)
+        if checkout_session['coin'] == None:
+            return await interaction.response.send_message("Select a crypto payment method first", ephemeral=True)
+        # Check if txid exists
+        deposit = await self.deposits.get_deposit(txid, checkout_session['coin'])
+        if deposit == None:
+            return await interaction.response.send_message("Txid does not exist", ephemeral=True)
+        if deposit['status'] != DEPOSIT_SUCCESS:
+            return await interaction.response.send_message("Your deposit hasn't been credited yet, try again in a few minutes", ephemeral=True)
+        # Check if amount is correct
+        expected_amount = checkout_session.get('crypto_amount') or checkout_session['total_price']
+        if float(deposit['amount']) < expected_amount * (1 - PAYMENT_TOLERANCE):
+            return await interaction.response.send_message(f"Amount is not correct: {deposit['amount']} ≠ {expected_amount}", ephemeral=True)
+        # Check if date is correct
+        if deposit_time(deposit) < checkout_session['createdAt']:
+            return await interaction.response.send_message(f"Transaction date is older than checkout session", ephemeral=True)
+        await interaction.response.defer()
+        # The payment matcher may have completed the session already and a txid can only pay once
+        checkout_session = await self.mongo.claim_checkout_session(checkout_session['_id'], txid)
+        if checkout_session == None:
+            return await interaction.followup.send("This transaction has already been used")
+        if not await fulfil_checkout(self.mongo, checkout_session, interaction.followup.send):
+            return await interaction.followup.send("There are not enough accounts available.\n For further support ping a Moderator")
 
     @app_commands.command(name="cancel_checkout", description="Cancel Checkout Session")
     @app_commands.checks.has_permissions(administrator=True)
@@ -132,36 +90,50 @@ class Shop(commands.Cog):
         # Log command
         await self.log(interaction.user, f'{interaction.command.name} {client}')
         client_id = client.strip('<@>')
-        checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(client_id))
+        checkout_session = await self.mongo.get_pending_checkout_session_by_user_id(str(client_id))
         if checkout_session == None:
             return await interaction.response.send_message("No pending checkout session", ephemeral=True)
-        MongoController().delete_checkout_session(checkout_session['_id'])
+        # /autocheckout or the payment matcher may have claimed it in the meantime, a paid session is never cancelled
+        if await self.mongo.cancel_checkout_session(checkout_session['_id'], checkout_session['user_id']) is None:
+            return await interaction.response.send_message("The checkout session is no longer pending, it was paid or expired", ephemeral=True)
+        self.client.holds.cancel(checkout_session['_id'])
         await interaction.response.send_message("Checkout session cancelled", ephemeral=False)
 
 
+# Sent when a view outlives its checkout session (expired, cancelled, paid or another coin picked)
+SESSION_EXPIRED = "This checkout session is no longer valid, use `/buy` to start a new one"
+
+
 class SelectAddressInfoView(discord.ui.View):
-    def __init__(self, invoker=None):
+    def __init__(self, mongo, binance, invoker=None):
         super().__init__(timeout=900)
-        self.add_item(SelectAddressMenu(invoker))
+        self.mongo = mongo
+        self.add_item(SelectAddressMenu(mongo, binance, invoker))
 
 class SelectAddressView(discord.ui.View):
-    def __init__(self, invoker=None):
+    def __init__(self, mongo, binance, invoker=None, checkout_session=None):
         super().__init__(timeout=900)
-        self.add_item(SelectAddressMenu(invoker))
+        self.mongo = mongo
+        self.checkout_session = checkout_session
+        self.add_item(SelectAddressMenu(mongo, binance, invoker, checkout_session))
 
     @discord.ui.button(label="Cancel Checkout", style=discord.ButtonStyle.gray, emoji="❌", custom_id='cancel_sesion_1')
+    @metrics.timed("ui", "cancel_checkout_session")
     async def cancel_checkout_session(self, interaction: discord.Interaction, button):
-        checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))
-        if checkout_session != [] or checkout_session != None:
-            MongoController().delete_checkout_session(checkout_session['_id'])
+        # Only the buyer can cancel and only while the session is unpaid
+        if await self.mongo.cancel_checkout_session(self.checkout_session['_id'], str(interaction.user.id)) is None:
+            return await interaction.response.send_message(SESSION_EXPIRED, ephemeral=True)
         await interaction.response.send_message("Checkout session cancelled", ephemeral=True)
 
         # Delete message
         await interaction.message.delete()
 
 class SelectAddressMenu(discord.ui.Select):
-    def __init__(self, invoker=None):
+    def __init__(self, mongo, binance, invoker=None, checkout_session=None):
+        self.mongo = mongo
+        self.binance = binance
         self.invoker = invoker
+        self.checkout_session = checkout_session
         options = [discord.SelectOption(label="USDT", description="Thether usd", emoji="<:icons8tether144:1072903017038352565>"),
                    discord.SelectOption(label="LTC", description="Litecoin", emoji="<:icons8litecoin128:1072903013443829812>"),
                    discord.SelectOption(label="BTC", description="Bitcoin", emoji="<:icons8bitcoin144:1072903009689935882>"),
@@ -170,64 +142,67 @@ class SelectAddressMenu(discord.ui.Select):
                    discord.SelectOption(label="Binance Pay", description="Binance Pay ID - 0 fees", emoji="<:icons8binance128:1072903008444223568>")]
         super().__init__(placeholder="Select payment option", options=options)
     
+    @metrics.timed("ui", "select_address")
     async def callback(self, interaction: discord.Interaction):
         if self.values[0] == "Revolut":
-            revolut_address = MongoController().get_revolut_address()
+            revolut_address = await self.mongo.get_revolut_address()
             
             if self.invoker == None:
                 return await interaction.response.send_message(f'**{revolut_address}**')
-            # Get checkout session
-            checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))   
-            MongoController().set_session_payment_method(checkout_session['_id'], "Revolut")
+            checkout_session = await self.mongo.select_session_payment(self.checkout_session['_id'], "Revolut")
+            if checkout_session is None:
+                return await interaction.response.send_message(SESSION_EXPIRED, ephemeral=True)
             return await interaction.response.send_message(f"Please send **{checkout_session['total_price']}€** to **{revolut_address}**")
             
         elif self.values[0] == "Binance Pay":
-            binance_pay = MongoController().get_binance_payid_address()
+            binance_pay = await self.mongo.get_binance_payid_address()
             if self.invoker == None:
                 return await interaction.response.send_message(f'**{binance_pay}**')
-            # Get checkout session
-            checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))
-            MongoController().set_session_payment_method(checkout_session['_id'], "Crypto")
+            checkout_session = await self.mongo.select_session_payment(self.checkout_session['_id'], "Crypto")
+            if checkout_session is None:
+                return await interaction.response.send_message(SESSION_EXPIRED, ephemeral=True)
             return await interaction.response.send_message(f"Send **{checkout_session['total_price']}€** to **{binance_pay}**")
             
             
         else:
             await interaction.response.defer()
             if self.invoker == None:
-                return await interaction.followup.send("Select a network", view=SelectNetworkView(BinanceController().get_coin_networks(self.values[0]), self.values[0]))
-            # Get checkout session
-            checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id)) 
-            MongoController().set_session_payment_method(checkout_session['_id'], "Crypto")
-            MongoController().set_session_coin(checkout_session['_id'], self.values[0])
+                return await interaction.followup.send("Select a network", view=SelectNetworkView(self.mongo, self.binance, await self.binance.get_coin_networks(self.values[0]), self.values[0]))
+            checkout_session = await self.mongo.select_session_payment(self.checkout_session['_id'], "Crypto", self.values[0])
+            if checkout_session is None:
+                return await interaction.followup.send(SESSION_EXPIRED, ephemeral=True)
 
-            await interaction.followup.send("Select a network", view=SelectNetworkView(BinanceController().get_coin_networks(self.values[0]), self.values[0], self.invoker))
+            await interaction.followup.send("Select a network", view=SelectNetworkView(self.mongo, self.binance, await self.binance.get_coin_networks(self.values[0]), self.values[0], self.invoker, checkout_session))
 
 
 class SelectNetworkView(discord.ui.View):
-    def __init__(self, options, coin, invoker=None):
+    def __init__(self, mongo, binance, options, coin, invoker=None, checkout_session=None):
         super().__init__(timeout=900)
-        self.add_item(SelectNetworkMenu(options, coin, invoker))   
+        self.add_item(SelectNetworkMenu(mongo, binance, options, coin, invoker, checkout_session))   
 
 class SelectNetworkMenu(discord.ui.Select):
-    def __init__(self, options, coin, invoker=None):
+    def __init__(self, mongo, binance, options, coin, invoker=None, checkout_session=None):
+        self.mongo = mongo
+        self.binance = binance
         self.invoker = invoker
         self.coin = coin
+        self.checkout_session = checkout_session
         options = [discord.SelectOption(label=network, description=name) for network, name in options.items()]
         super().__init__(placeholder="Chose a network", options=options)
     
+    @metrics.timed("ui", "select_network")
     async def callback(self, interaction: discord.Interaction):
         await interaction.response.defer()
         # Get checkout session
         if self.invoker == None:
-            return await interaction.followup.send(BinanceController().get_deposit_address(self.coin, self.values[0])['address'])
-        checkout_session = MongoController().get_pending_checkout_session_by_user_id(str(interaction.user.id))
-        MongoController().set_session_network(checkout_session['_id'], self.values[0])
+            return await interaction.followup.send((await self.binance.get_deposit_address(self.coin, self.values[0]))['address'])
         # TODO: Add a way to make discounts on crypto payment
-        if self.coin == "USDT":
-            crypto_price = round(float(checkout_session['total_price'])*float(BinanceController().get_coin_price_EUR("USDT")),2)
-        else:
-            crypto_price = round(float(checkout_session['total_price'])/float(BinanceController().get_coin_price_EUR(self.coin)),6)
-        return await interaction.followup.send(f"Please send **{crypto_price} {self.coin}** ({checkout_session['total_price']}€)  to **{BinanceController().get_deposit_address(self.coin, self.values[0])['address']}**")
+        crypto_price = round(float(self.checkout_session['total_price'])/(await self.binance.get_coin_price_EUR(self.coin)), 2 if self.coin == "USDT" else 6)
+        # The payment matcher uses this amount to recognise the deposit, it is made unique among the open sessions
+        checkout_session = await self.mongo.select_session_network(self.checkout_session['_id'], self.coin, self.values[0], crypto_price, amount_decimals(self.coin))
+        if checkout_session is None:
+            return await interaction.followup.send(SESSION_EXPIRED, ephemeral=True)
+        return await interaction.followup.send(f"Please send **{checkout_session['crypto_amount']:.{amount_decimals(self.coin)}f} {self.coin}** ({checkout_session['total_price']}€)  to **{(await self.binance.get_deposit_address(self.coin, self.values[0]))['address']}**")
 
 
 
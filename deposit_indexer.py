@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Binance deposit statuses that can still change (pending, credited but locked, waiting user confirmation)
+OPEN_DEPOSIT_STATUSES = (0, 6, 8)
+# Binance only returns the last 90 days of deposit history
+HISTORY_WINDOW_MS = 90 * 24 * 60 * 60 * 1000
+PAGE_SIZE = 1000
+
+
+class DepositIndexer:
+    """Keeps an in-memory txid -> deposit index of the Binance deposit history, persisted in the Deposits collection"""
+
+    def __init__(self, binance, mongo, interval=30):
+        self.binance = binance
+        self.mongo = mongo
+        self.interval = interval
+        self.deposits = {}
+        # txids of deposits that can still change and the insertTime of the newest deposit
+        self.open_txids = set()
+        self.newest_insert_time = 0
+        self.poll_lock = asyncio.Lock()
+        self.task = None
+        self.listeners = []
+        # Running listener calls, the event loop only keeps weak references to tasks
+        self.listener_tasks = set()
+
+    async def start(self):
+        """Loads the persisted deposits and starts polling Binance"""
+        for deposit in await self.mongo.get_all_deposits():
+            self._index(deposit)
+        logger.info("Loaded %s deposits from the database", len(self.deposits))
+        if self.task is None:
+            self.task = asyncio.create_task(self._poll_loop())
+
+    def add_listener(self, listener):
+        """Registers a coroutine function that is called with the deposits that are new or changed"""
+        self.listeners.append(listener)
+
+    def close(self):
+        """Stops polling Binance"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def high_water_mark(self):
+        """Returns the startTime (ms) to poll from, the oldest deposit that can still change or the newest deposit"""
+        if self.open_txids:
+            return min(self.deposits[txid]["insertTime"] for txid in self.open_txids)
+        if self.newest_insert_time:
+            return self.newest_insert_time
+        return int(time.time() * 1000) - HISTORY_WINDOW_MS
+
+    def _index(self, deposit):
+        self.deposits[deposit["txId"]] = deposit
+        self.newest_insert_time = max(self.newest_insert_time, deposit["insertTime"])
+        if deposit["status"] in OPEN_DEPOSIT_STATUSES:
+            self.open_txids.add(deposit["txId"])
+        else:
+            self.open_txids.discard(deposit["txId"])
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Deposit poll failed")
+            # Binance is not asked again before a rate limit is over
+            await asyncio.sleep(max(self.interval, self.binance.ban_remaining()))
+
+    async def poll(self, txid=None):
+        """Downloads the deposits since the high water mark (or the deposit with txid) and indexes them"""
+        async with self.poll_lock:
+            changed = []
+            offset = 0
+            start_time = None if txid is not None else self.high_water_mark()
+            while True:
+                page = await self.binance.get_deposit_history(start_time=start_time, txid=txid, offset=offset, limit=PAGE_SIZE)
+                for deposit in page:
+                    if self.deposits.get(deposit["txId"]) != deposit:
+                        self._index(deposit)
+                        changed.append(deposit)
+                if len(page) < PAGE_SIZE:
+                    break
+                offset += PAGE_SIZE
+            if changed:
+                await self.mongo.upsert_deposits(changed)
+                # Listeners run on their own so they don't hold the poll lock
+                for listener in self.listeners:
+                    task = asyncio.create_task(listener(changed))
+                    self.listener_tasks.add(task)
+                    task.add_done_callback(self.listener_tasks.discard)
+            return changed
+
+    async def get_deposit(self, txid, coin=None):
+        """Returns the deposit with txid, Binance is only asked (once) if the index doesn't know it yet"""
+        deposit = self.deposits.get(txid)
+        if deposit is None or deposit["status"] in OPEN_DEPOSIT_STATUSES:
+            await self.poll(txid=txid)
+            deposit = self.deposits.get(txid)
+        if deposit is None or (coin is not None and deposit["coin"] != coin):
+            return None
+        return deposit
@@ -0,0 +1,70 @@
+from checkout import CHECKOUT_WINDOW
+from datetime import datetime
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HoldScheduler:
+    """Expires pending checkout sessions at the end of their window, releases their held accounts and tells the client"""
+
+    def __init__(self, client, window=CHECKOUT_WINDOW):
+        self.client = client
+        self.mongo = client.mongo
+        self.window = window
+        # session id -> timer handle
+        self.timers = {}
+        # Running expirations, the event loop only keeps weak references to tasks
+        self.tasks = set()
+
+    async def start(self):
+        """Schedules the pending sessions and releases the holds left by sessions that expired while the bot was down"""
+        await self.sweep()
+
+    async def sweep(self):
+        """Schedules the pending sessions that have no timer and releases the holds of sessions that don't exist anymore"""
+        # A session whose expiration failed stays pending without a timer, it is expired again here
+        for checkout_session in await self.mongo.get_pending_checkout_sessions():
+            if str(checkout_session["_id"]) not in self.timers:
+                self.schedule(checkout_session)
+        orphans = await self.mongo.release_orphan_holds()
+        if orphans:
+            logger.warning("Released the holds of %s expired checkout sessions", len(orphans))
+
+    def schedule(self, checkout_session):
+        """Expires a checkout session when its window ends"""
+        id = str(checkout_session["_id"])
+        delay = (checkout_session["createdAt"] + self.window - datetime.now()).total_seconds()
+        self.cancel(id)
+        self.timers[id] = asyncio.get_running_loop().call_later(max(delay, 0), self._start_expire, id, checkout_session["user_id"])
+
+    def _start_expire(self, id, user_id):
+        task = asyncio.create_task(self.expire(id, user_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def cancel(self, id):
+        """Forgets the timer of a checkout session that was paid or cancelled"""
+        timer = self.timers.pop(str(id), None)
+        if timer is not None:
+            timer.cancel()
+
+    def close(self):
+        """Cancels every timer, the sessions are scheduled again at the next start"""
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+
+    async def expire(self, id, user_id):
+        self.timers.pop(id, None)
+        try:
+            # Nothing happens if the session was paid or cancelled in the meantime
+            if await self.mongo.expire_checkout_session(id) is None:
+                return
+            channel_id = self.client.tickets.channel_of(int(user_id))
+            channel = self.client.get_channel(channel_id) if channel_id is not None else None
+            if channel is not None:
+                await channel.send(f"<@{user_id}> Your checkout session expired and the accounts put aside for you are back in stock. Use `/buy` to start a new one, a payment you already sent is still processed once it is confirmed")
+        except Exception:
+            logger.exception("Could not expire checkout session %s", id)
@@ -0,0 +1,363 @@
+from mongo_controller import MongoController
+from async_mongo_controller import AsyncMongoController
+from binance_controller import BinanceController
+from deposit_indexer import DepositIndexer
+from payment_matcher import PaymentMatcher
+from audit_logger import AuditLogger
+from ticket_registry import TicketRegistry
+from hold_scheduler import HoldScheduler
+from checkout import amount_decimals
+from account_importer import import_accounts_async
+from benchmark import DATABASE, PRICES, RESULTS_DIR, fake_binance_app
+from cogs.Admin import Admin
+from cogs.Shop import Shop
+from cogs.Ticket import TicketMenu
+from metrics import metrics
+from collections import Counter
+from datetime import datetime
+from aiohttp import web
+import argparse
+import asyncio
+import discord
+import itertools
+import json
+import os
+import random
+import re
+import time
+
+# This program simulates a restock rush: many buyers open a ticket, /buy, pick a coin and a network and pay at once
+# The cogs and their views run as in the bot with fake interactions, no Discord connection is needed
+# Usage: python load_test.py --mongo-url mongodb://localhost:27017 --buyers 300 --stock 1000
+
+ids = itertools.count(10**17)
+
+
+class FakeUser:
+    def __init__(self, name, administrator=False):
+        self.id = next(ids)
+        self.name = name
+        self.guild_permissions = discord.Permissions(administrator=administrator)
+
+    def __str__(self):
+        return self.name
+
+    async def add_roles(self, *roles):
+        pass
+
+
+class FakeMessage:
+    async def delete(self):
+        pass
+
+
+class FakeChannel:
+    """Text channel that keeps every message sent to it"""
+
+    def __init__(self, name):
+        self.id = next(ids)
+        self.name = name
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append((content, kwargs))
+        return FakeMessage()
+
+    async def set_permissions(self, *args, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+    def delivered_accounts(self):
+        """Returns the accounts sent to the channel, from code blocks and files"""
+        accounts = []
+        for content, kwargs in self.messages:
+            if content and content.startswith("Here are your accounts"):
+                accounts += re.search(r"```(.*)```", content, re.S).group(1).split("\n")
+            elif "file" in kwargs:
+                kwargs["file"].fp.seek(0)
+                accounts += kwargs["file"].fp.read().decode("utf-8").split("\n")
+        return [account for account in accounts if account]
+
+    def turned_down(self):
+        """Returns True if the order of the channel was refused for lack of stock"""
+        return any("not enough accounts" in (content or "").lower() for content, kwargs in self.messages)
+
+
+class FakeGuild:
+    def __init__(self, bot):
+        self.id = next(ids)
+        self.bot = bot
+        self.roles = []
+
+    def get_role(self, id):
+        return None
+
+    async def create_text_channel(self, name):
+        await asyncio.sleep(0)
+        return self.bot.add_channel(FakeChannel(name))
+
+    async def fetch_member(self, id):
+        return FakeUser(str(id))
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def send_message(self, content=None, **kwargs):
+        self.done = True
+        await self.interaction.channel.send(content, **kwargs)
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        return await self.interaction.channel.send(content, **kwargs)
+
+
+class FakeInteraction:
+    """The parts of discord.Interaction the cogs and views use"""
+
+    def __init__(self, user, channel, guild, command=None):
+        self.user = user
+        self.channel = channel
+        self.guild = guild
+        self.command = command
+        self.message = FakeMessage()
+        self.extras = {}
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+
+class FakeBot:
+    """The parts of the bot the cogs use"""
+
+    def __init__(self, mongo, binance, deposits):
+        self.mongo = mongo
+        self.binance = binance
+        self.deposits = deposits
+        self.channels = {}
+        self.log_channel = self.add_channel(FakeChannel("logs"))
+        self.audit = AuditLogger(self, self.log_channel.id)
+        self.tickets = TicketRegistry(mongo)
+
+    def add_channel(self, channel):
+        self.channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, id):
+        return self.channels.get(id)
+
+
+async def measure_loop_lag(interval=0.01):
+    """Records how late the event loop wakes a task up, a busy loop delays every interaction"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.observe("loop", "lag", max(time.perf_counter() - start - interval, 0))
+
+
+def last_view(channel):
+    """Returns the view of the last message sent to a channel, None if it had no view"""
+    return channel.messages[-1][1].get("view") if channel.messages else None
+
+
+async def choose(select, interaction, value):
+    """Picks value in a select menu and runs its callback"""
+    # Select.values falls back to _values when the interaction carries no selection
+    select._values = [value]
+    await select.callback(interaction)
+
+
+def order_size(args):
+    """Draws the number of accounts of an order, a share of the orders are large enough to be sent as a file"""
+    if random.random() < args.large_orders:
+        return random.randint(20, max(args.max_large_accounts, 20))
+    return random.randint(1, args.max_accounts)
+
+
+async def step(name, coroutine):
+    with metrics.timer("interaction", name):
+        return await coroutine
+
+
+async def buyer(bot, guild, shop, ticket_menu, deposits, n_accounts, pay_delay, autocheckout=True):
+    """Runs the whole checkout of one buyer, returns them, their ticket channel, the number of accounts they asked for and whether they paid"""
+    user = FakeUser(f"buyer{next(ids)}")
+    lobby = FakeChannel("open-ticket")
+    await step("open_ticket", ticket_menu.open_ticket.callback(FakeInteraction(user, lobby, guild)))
+    channel = bot.get_channel(bot.tickets.channel_of(user.id))
+    await step("/buy", shop.buy.callback(shop, FakeInteraction(user, channel, guild, shop.buy), str(n_accounts)))
+    view = last_view(channel)
+    if view is None:
+        # Turned down, not enough stock
+        return user, channel, n_accounts, False
+    select = next(item for item in view.children if isinstance(item, discord.ui.Select))
+    await step("select_address", choose(select, FakeInteraction(user, channel, guild), "USDT"))
+    network_view = last_view(channel)
+    await step("select_network", choose(network_view.children[0], FakeInteraction(user, channel, guild), "TRX"))
+    checkout_session = await bot.mongo.get_pending_checkout_session_by_user_id(str(user.id))
+    # The buyer pays, Binance sees the deposit a little later
+    await asyncio.sleep(random.uniform(0, pay_delay))
+    txid = f"load-{user.id}"
+    deposits.append({"id": txid, "amount": f"{checkout_session['crypto_amount']:.{amount_decimals('USDT')}f}", "coin": "USDT", "network": "TRX", "status": 1,
+                     "address": "address", "txId": txid, "insertTime": int(time.time() * 1000)})
+    if autocheckout:
+        # Buyers don't wait for the payment matcher, they race it with /autocheckout
+        await step("/autocheckout", shop.autocheckout.callback(shop, FakeInteraction(user, channel, guild, shop.autocheckout), txid))
+    return user, channel, n_accounts, True
+
+
+async def admin_gen(admin, guild, n_accounts):
+    """Runs /gen as an admin, returns them, the channel the accounts were sent to and the number of accounts asked for"""
+    channel = FakeChannel("admin")
+    user = FakeUser("admin", administrator=True)
+    await step("/gen", admin.gen.callback(admin, FakeInteraction(user, channel, guild, admin.gen), n_accounts, f"<@{next(ids)}>", 1.0 * n_accounts, "USDT"))
+    return user, channel, n_accounts, False
+
+
+async def load_test(args):
+    controller = MongoController(args.mongo_url, max_pool_size=args.pool_size, database=DATABASE)
+    controller.client.drop_database(DATABASE)
+    mongo = AsyncMongoController(controller)
+    await mongo.create_indexes()
+    for price in PRICES:
+        await mongo.set_account_price(price["step"], price["price"])
+    await import_accounts_async(mongo, (f"account{i}@mail.com:password" for i in range(args.stock)), "cartable")
+    await mongo.reconcile_stock()
+
+    deposits = []
+    server = web.AppRunner(fake_binance_app(deposits, args.binance_latency / 1000))
+    await server.setup()
+    await web.TCPSite(server, "127.0.0.1", args.binance_port).start()
+    binance = BinanceController("key", "secret", base_url=f"http://127.0.0.1:{args.binance_port}")
+    await binance.start()
+    indexer = DepositIndexer(binance, mongo, interval=args.poll_interval)
+    bot = FakeBot(mongo, binance, indexer)
+    await indexer.start()
+    PaymentMatcher(bot).start()
+    bot.holds = HoldScheduler(bot)
+    bot.audit.start()
+    guild = FakeGuild(bot)
+    shop, admin, ticket_menu = Shop(bot), Admin(bot), TicketMenu(mongo, bot.tickets)
+
+    lag_task = asyncio.create_task(measure_loop_lag())
+    check_outs = controller.get_pool_stats()["check_outs"]
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    print(f"{args.buyers} buyers and {args.admin_gens} /gen against {args.stock} accounts, {args.concurrency} at a time...")
+    start = time.perf_counter()
+    tasks = [limited(buyer(bot, guild, shop, ticket_menu, deposits, order_size(args), args.pay_delay, not args.matcher_only)) for _ in range(args.buyers)]
+    tasks += [limited(admin_gen(admin, guild, order_size(args))) for _ in range(args.admin_gens)]
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+    # Let the payment matcher finish what it started
+    await asyncio.sleep(args.poll_interval * 2)
+    elapsed = time.perf_counter() - start
+    lag_task.cancel()
+
+    errors = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+    channels = [outcome[1] for outcome in outcomes if not isinstance(outcome, Exception)]
+    delivered = Counter()
+    buyers_delivered_twice = 0
+    for channel in channels:
+        accounts = channel.delivered_accounts()
+        delivered.update(accounts)
+        if sum(1 for content, kwargs in channel.messages if (content or "").startswith("Here are your accounts") or "file" in kwargs) > 1:
+            buyers_delivered_twice += 1
+    sold = await mongo.get_accounts_page("sold", limit=args.stock + 1)
+    cartable_left = len(await mongo.get_accounts_page("cartable", limit=args.stock + 1))
+    # Orders turned down for lack of stock, an order that still fits in the stock left at the end should have been served
+    buyers_turned_down = [outcome[2] for outcome in outcomes[:args.buyers] if not isinstance(outcome, Exception) and outcome[1].turned_down()]
+    gens_turned_down = [outcome[2] for outcome in outcomes[args.buyers:] if not isinstance(outcome, Exception) and outcome[1].turned_down()]
+    false_rejections = sum(1 for n in buyers_turned_down + gens_turned_down if n <= cartable_left)
+    # Buyers who paid and never got their accounts, with --matcher-only this is every deposit the matcher couldn't match
+    buyers_unserved = sum(1 for outcome in outcomes[:args.buyers] if not isinstance(outcome, Exception) and outcome[3] and not outcome[1].delivered_accounts() and not outcome[1].turned_down())
+    interactions = sum(row["count"] for row in metrics.summary("interaction"))
+    report = {
+        "date": datetime.now().isoformat(),
+        "settings": vars(args),
+        "seconds": elapsed,
+        "interactions": interactions,
+        "errors": [repr(error) for error in errors[:20]],
+        "n_errors": len(errors),
+        "accounts_delivered": sum(delivered.values()),
+        "accounts_sold_in_db": len(sold),
+        "cartable_left": cartable_left,
+        "buyers_turned_down": len(buyers_turned_down),
+        "gens_turned_down": len(gens_turned_down),
+        "false_rejections": false_rejections,
+        "buyers_paid_not_served": buyers_unserved,
+        "oversold": max(sum(delivered.values()) - args.stock, 0),
+        "accounts_delivered_twice": sum(1 for n in delivered.values() if n > 1),
+        "buyers_delivered_twice": buyers_delivered_twice,
+        "mongo_check_outs_per_interaction": (controller.get_pool_stats()["check_outs"] - check_outs) / max(interactions, 1),
+        "latency": [{key: value for key, value in row.items() if key != "total"} for row in metrics.summary()],
+    }
+
+    print(f"{interactions} interactions in {elapsed:.1f}s, {len(errors)} errors")
+    for row in metrics.summary("interaction") + metrics.summary("loop"):
+        print(f"{row['kind'] + ' ' + row['name']:<32} n={row['count']:<6} p50={row['p50']*1000:>8.1f}ms p99={row['p99']*1000:>8.1f}ms")
+    print(f"Mongo check-outs per interaction: {report['mongo_check_outs_per_interaction']:.1f}")
+    print(f"Delivered {report['accounts_delivered']} accounts, {report['accounts_sold_in_db']} sold in the database")
+    print(f"Oversold: {report['oversold']}, accounts delivered twice: {report['accounts_delivered_twice']}, buyers delivered twice: {report['buyers_delivered_twice']}")
+    print(f"Turned down: {len(buyers_turned_down)} buyers and {len(gens_turned_down)} /gen, {cartable_left} accounts left in stock")
+    if false_rejections:
+        print(f"FAILED: {false_rejections} orders were turned down although the stock left could fill them")
+    if buyers_unserved:
+        print(f"FAILED: {buyers_unserved} buyers paid and got no accounts")
+
+    indexer.close()
+    bot.holds.close()
+    await bot.audit.close()
+    await binance.close()
+    await server.cleanup()
+    mongo.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates many buyers checking out at once against a local mongod and a fake Binance")
+    parser.add_argument("--mongo-url", default=os.getenv('BENCHMARK_MONGO_URL', "mongodb://localhost:27017"))
+    parser.add_argument("--pool-size", type=int, default=50)
+    parser.add_argument("--buyers", type=int, default=300)
+    parser.add_argument("--admin-gens", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=300)
+    parser.add_argument("--stock", type=int, default=1000, help="Accounts in stock, less than the buyers ask for to check nothing is oversold")
+    parser.add_argument("--max-accounts", type=int, default=10, help="Most accounts a small order asks for")
+    parser.add_argument("--large-orders", type=float, default=0.2, help="Share of the orders that ask for 20 accounts or more, they are sent as a file")
+    parser.add_argument("--max-large-accounts", type=int, default=50, help="Most accounts a large order asks for")
+    parser.add_argument("--pay-delay", type=float, default=2, help="Most seconds a buyer takes to pay")
+    parser.add_argument("--poll-interval", type=float, default=1, help="Seconds between deposit polls")
+    parser.add_argument("--matcher-only", action="store_true", help="Buyers never run /autocheckout, every checkout has to be completed by the payment matcher")
+    parser.add_argument("--binance-port", type=int, default=8766)
+    parser.add_argument("--binance-latency", type=float, default=50, help="Delay of every fake Binance response in ms")
+    args = parser.parse_args()
+
+    report = asyncio.run(load_test(args))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    file_name = os.path.join(RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(file_name, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Results saved to {file_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+# Latency histogram buckets in seconds, the same for every metric so they can be compared
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+    """Counts observations in BUCKETS, quantiles are interpolated inside the bucket they fall in"""
+
+    def __init__(self):
+        # One more count for the observations above the last bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Returns an estimate of the q quantile in seconds"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """Latency histograms of the bot, one per (kind, name): app commands, ui callbacks, mongo methods and binance calls"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.started = time.time()
+
+    def observe(self, kind, name, seconds, error=False):
+        """Records a call of name that took seconds"""
+        # Called from the event loop and the mongo worker threads
+        with self._lock:
+            histogram = self.histograms.get((kind, name))
+            if histogram is None:
+                histogram = self.histograms[(kind, name)] = Histogram()
+            histogram.observe(seconds, error)
+
+    def summary(self, kind=None):
+        """Returns [{kind, name, count, errors, rate, p50, p99, mean}] sorted by total time, rate is calls per second since startup"""
+        uptime = max(time.time() - self.started, 1)
+        with self._lock:
+            rows = [{"kind": k, "name": name, "count": h.count, "errors": h.errors, "rate": h.count / uptime,
+                     "p50": h.quantile(0.5), "p99": h.quantile(0.99), "mean": h.sum / h.count, "total": h.sum}
+                    for (k, name), h in self.histograms.items() if kind is None or k == kind]
+        return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+    def render_prometheus(self):
+        """Returns the histograms in the Prometheus text format"""
+        lines = ["# HELP plugbot_latency_seconds Latency of bot commands, callbacks and backend calls",
+                 "# TYPE plugbot_latency_seconds histogram"]
+        errors = ["# HELP plugbot_errors_total Calls that raised",
+                  "# TYPE plugbot_errors_total counter"]
+        with self._lock:
+            for (kind, name), h in sorted(self.histograms.items()):
+                labels = f'kind="{kind}",name="{name}"'
+                cumulative = 0
+                for bucket, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'plugbot_latency_seconds_bucket{{{labels},le="{bucket}"}} {cumulative}')
+                lines.append(f'plugbot_latency_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f"plugbot_latency_seconds_sum{{{labels}}} {h.sum}")
+                lines.append(f"plugbot_latency_seconds_count{{{labels}}} {h.count}")
+                errors.append(f"plugbot_errors_total{{{labels}}} {h.errors}")
+        return "\n".join(lines + errors) + "\n"
+
+    @contextmanager
+    def timer(self, kind, name):
+        """Context manager that records the latency of its block"""
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(kind, name, time.perf_counter() - start, error)
+
+    def timed(self, kind, name=None):
+        """Decorator that records the latency of a coroutine function"""
+        def decorator(function):
+            label = name or function.__name__
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with self.timer(kind, label):
+                    return await function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+# Shared by the whole bot
+metrics = Metrics()
+
+
+async def start_http_server(port, host="0.0.0.0"):
+    """Serves metrics.render_prometheus() on http://host:port/metrics, returns the runner to clean it up"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
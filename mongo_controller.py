@@ -1,23 +1,272 @@
-from pymongo import MongoClient
-from datetime import datetime
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 from dotenv import load_dotenv
+from price_ladder import PriceLadder
+from stock_counter import StockCounter
+import logging
+import threading
+import random
 import os
 
-class MongoController:
+logger = logging.getLogger(__name__)
+
+# Purchase type -> array the purchases were embedded in before the Purchases collection
+LEGACY_CLIENT_ARRAYS = {"account_purchase": "account_purchases", "replacement": "replacements", "service": "service_purchases"}
+# Client reads never return the legacy arrays
+CLIENT_PROJECTION = {"_id":0, **{field:0 for field in LEGACY_CLIENT_ARRAYS.values()}}
+# Client running total used by each leaderboard metric
+LEADERBOARD_FIELDS = {"revenue": "total_revenue", "accounts": "total_accounts", "replacements": "total_replacements"}
+# Expired checkout sessions can still be paid this long, a deposit sent in time may confirm after the session expired
+EXPIRED_SESSION_GRACE = timedelta(hours=2)
+
+
+# Indexes every query of the bot relies on: collection -> [(keys, options)]
+# They are ensured at startup, creating an index that already exists does nothing
+INDEXES = {
+    "Accounts": [
+        ([("account", 1)], {"unique": True}),
+        # Stock counts, reservations and exports page through the accounts of a status in _id order
+        ([("status", 1), ("_id", 1)], {}),
+        # Accounts held or sold for an order are found without a scan
+        ([("order_id", 1), ("status", 1)], {"partialFilterExpression": {"order_id": {"$exists": True}}}),
+    ],
+    "Tickets": [
+        ([("user_id", 1)], {"unique": True}),
+        ([("channel_id", 1)], {"unique": True}),
+    ],
+    "CheckoutSessions": [
+        # Pending sessions are expired by the hold scheduler at 15 minutes, this TTL only
+        # cleans up after a bot that was down at the time (the held stock is released at startup)
+        ([("createdAt", 1)], {"expireAfterSeconds": 3600, "partialFilterExpression": {"status": "pending"}}),
+        # Expired sessions are kept for the grace period in which a late deposit can still pay them
+        ([("expiredAt", 1)], {"expireAfterSeconds": int(EXPIRED_SESSION_GRACE.total_seconds()), "partialFilterExpression": {"status": "expired"}}),
+        ([("user_id", 1), ("status", 1)], {}),
+        # A user has one pending session and a txid pays one session
+        ([("user_id", 1)], {"unique": True, "partialFilterExpression": {"status": "pending"}}),
+        ([("txid", 1)], {"unique": True, "partialFilterExpression": {"txid": {"$type": "string"}}}),
+        ([("status", 1), ("coin", 1), ("network", 1), ("crypto_amount", 1)], {}),
+    ],
+    "Finance": [
+        ([("Date", 1)], {}),
+    ],
+    "FinanceRollups": [
+        ([("Day", 1), ("Type", 1), ("Payment_Method", 1)], {"unique": True}),
+    ],
+    "Clients": [
+        ([("client_id", 1)], {"unique": True}),
+        *[([(field, -1)], {}) for field in LEADERBOARD_FIELDS.values()],
+    ],
+    "Purchases": [
+        ([("client_id", 1), ("Type", 1), ("Date", -1)], {}),
+        ([("client_id", 1), ("Date", -1)], {}),
+    ],
+    "Deposits": [
+        ([("id", 1)], {"unique": True}),
+    ],
+    "AuditLog": [
+        ([("date", -1)], {}),
+        ([("member_id", 1), ("date", -1)], {}),
+    ],
+}
+# Error code of create_index when an index with the same keys and other options exists
+INDEX_OPTIONS_CONFLICT = 85
+# Queries run by the handlers, checked by explain_hot_queries: (name, collection, filter, sort)
+HOT_QUERIES = [
+    ("stock count", "Accounts", {"status": "cartable"}, None),
+    ("reservation seek", "Accounts", {"status": "cartable", "_id": {"$gte": ObjectId("0" * 24)}}, [("_id", 1)]),
+    ("account lookup", "Accounts", {"account": ""}, None),
+    ("ticket by user", "Tickets", {"user_id": 0}, None),
+    ("ticket by channel", "Tickets", {"channel_id": 0}, None),
+    ("pending checkout", "CheckoutSessions", {"user_id": "", "status": "pending"}, None),
+    ("checkout by txid", "CheckoutSessions", {"txid": ""}, None),
+    ("deposit match", "CheckoutSessions", {"status": {"$in": ["pending", "expired"]}, "coin": "", "network": "", "crypto_amount": {"$gte": 0, "$lte": 1}}, None),
+    ("finance range", "Finance", {"Date": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("finance rollups", "FinanceRollups", {"Day": {"$gte": datetime(2000, 1, 1)}}, None),
+    ("client lookup", "Clients", {"client_id": ""}, None),
+    ("leaderboard", "Clients", {}, [("total_revenue", -1)]),
+    ("client history", "Purchases", {"client_id": ""}, [("Date", -1)]),
+]
+
+
+def plan_stages(plan):
+    """Returns the stages of an explain plan, children included"""
+    stages = [plan["stage"]]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child is not None:
+            stages += plan_stages(child)
+    return stages
+
+
+def payable_sessions():
+    """Returns the filter of the checkout sessions a payment can complete, pending ones and the ones that expired less than the grace period ago"""
+    return {"status": {"$in": ["pending", "expired"]}, "$or": [{"status":"pending"}, {"expiredAt": {"$gte": datetime.now() - EXPIRED_SESSION_GRACE}}]}
+
+
+def random_object_id(low, high):
+    """Returns a random ObjectId between low and high, low if they aren't ObjectIds"""
+    if not isinstance(low, ObjectId) or not isinstance(high, ObjectId) or high <= low:
+        return low
+    return ObjectId(format(random.randint(int(str(low), 16), int(str(high), 16)), "024x"))
+
+
+def day_of(date):
+    """Returns the start of the day of a datetime"""
+    return datetime(date.year, date.month, date.day)
+
+
+def purchase_document(client_id, purchase_type, purchase):
+    """Returns the Purchases document of a purchase, replacement or service of a client"""
+    return {"client_id": client_id, "Type": purchase_type, **purchase}
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events so the connection churn can be inspected"""
     def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {
+            "pools_created": 0,
+            "pools_cleared": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "check_outs": 0,
+            "check_out_failures": 0,
+            "checked_out": 0,
+        }
+
+    def _inc(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def pool_created(self, event):
+        self._inc("pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._inc("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._inc("connections_created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._inc("connections_closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._inc("check_out_failures")
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.stats["check_outs"] += 1
+            self.stats["checked_out"] += 1
+
+    def connection_checked_in(self, event):
+        self._inc("checked_out", -1)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["open_connections"] = stats["connections_created"] - stats["connections_closed"]
+        return stats
+
+
+class MongoController:
+    # Number of MongoClients created by this process, should stay at 1 while the bot is running
+    clients_created = 0
+
+    def __init__(self, mongo_url=None, max_pool_size=None, min_pool_size=None, database=None):
         load_dotenv()
-        mongo_url = os.getenv('MONGO_URL')
-        self.client = MongoClient(mongo_url)
-        self.db = self.client["Landohub"]
+        mongo_url = mongo_url or os.getenv('MONGO_URL')
+        self.max_pool_size = max_pool_size or int(os.getenv('MONGO_MAX_POOL_SIZE', 50))
+        self.min_pool_size = min_pool_size or int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+        self.pool_listener = PoolStatsListener()
+        self.client = MongoClient(mongo_url, maxPoolSize=self.max_pool_size, minPoolSize=self.min_pool_size, event_listeners=[self.pool_listener])
+        MongoController.clients_created += 1
+        self.db = self.client[database or os.getenv('MONGO_DATABASE', "Landohub")]
         self.addresses = self.db["Addresses"]
         self.finance = self.db["Finance"]
+        self.finance_rollups = self.db["FinanceRollups"]
         self.tickets = self.db["Tickets"]
         self.clients = self.db["Clients"]
+        self.purchases = self.db["Purchases"]
         self.prices = self.db["Prices"]
         self.accounts = self.db["Accounts"] 
         self.garbage_accounts = self.db["GarbageAccounts"]
         self.checkout_sessions = self.db["CheckoutSessions"]
+        self.deposits = self.db["Deposits"]
+        self.audit_log = self.db["AuditLog"]
+        self.price_ladder = None
+        self.price_ladder_lock = threading.Lock()
+        # Guards the rollup updates of finance inserts against a rebuild starting or ending, only held for a few writes
+        self.finance_lock = threading.Lock()
+        # Rollup updates of the statements inserted while a rebuild runs, None when no rebuild runs
+        self.finance_rebuild = None
+        self.finance_rebuild_lock = threading.Lock()
+        # Crypto amounts are picked one at a time so two open sessions are never asked the same amount
+        self.amount_lock = threading.Lock()
+        self.stock = StockCounter()
+
+    def close(self):
+        """Closes the connection pool"""
+        self.client.close()
+
+    def create_indexes(self):
+        """Ensures the indexes in INDEXES exist, returns [{collection, index, error}] for the ones that couldn't be created"""
+        errors = []
+        for collection, indexes in INDEXES.items():
+            for keys, options in indexes:
+                try:
+                    self.db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    if e.code == INDEX_OPTIONS_CONFLICT and "expireAfterSeconds" in options:
+                        # A TTL can be changed in place
+                        self.db.command("collMod", collection, index={"keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]})
+                        continue
+                    # An index with the same keys but other options, or duplicates in a unique field
+                    logger.error("Could not create index %s on %s: %s", keys, collection, e)
+                    errors.append({"collection": collection, "index": keys, "error": str(e)})
+        return errors
+
+    def missing_indexes(self):
+        """Returns [{collection, index}] for the indexes in INDEXES that don't exist"""
+        missing = []
+        for collection, indexes in INDEXES.items():
+            existing = [list(index["key"].items()) for index in self.db[collection].list_indexes()]
+            missing += [{"collection": collection, "index": keys} for keys, _ in indexes if keys not in existing]
+        return missing
+
+    def explain_hot_queries(self):
+        """Explains the queries in HOT_QUERIES, returns [{name, collection, stages, collscan}]"""
+        report = []
+        for name, collection, query, sort in HOT_QUERIES:
+            cursor = self.db[collection].find(query).limit(1)
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            # Sharded or newer servers nest the plan in a query plan
+            plan = plan.get("queryPlan", plan)
+            stages = plan_stages(plan)
+            report.append({"name": name, "collection": collection, "stages": stages, "collscan": "COLLSCAN" in stages})
+        return report
+
+    def get_pool_stats(self):
+        """Returns the connection pool statistics"""
+        stats = self.pool_listener.snapshot()
+        stats["max_pool_size"] = self.max_pool_size
+        stats["min_pool_size"] = self.min_pool_size
+        stats["clients_created"] = MongoController.clients_created
+        return stats
     
     def get_revolut_address(self):
         """Returns the revolut address from the database"""
@@ -33,52 +282,110 @@ class MongoController:
         """Returns the prices from the database"""
         return list(self.prices.find({}, {"_id": 0}).sort("step", 1))
     
+    def get_price_ladder(self):
+        """Returns the cached price ladder, it is loaded from the database the first time"""
+        if self.price_ladder is None:
+            with self.price_ladder_lock:
+                if self.price_ladder is None:
+                    self.price_ladder = PriceLadder(self.get_account_prices())
+        return self.price_ladder
+
     def get_n_accounts_price(self, number_of_accounts):
         """Returns the price of an amount of accounts"""
-        # Get the prices from the database
-        prices = self.get_account_prices()
-        # Get the price for the number of accounts
-        if number_of_accounts >= prices[-1]["step"]:
-            return prices[-1]["price"]
-        for i in range(len(prices)-1):
-            if prices[i]["step"] <= number_of_accounts and number_of_accounts < prices[i+1]["step"]:
-                return prices[i]["price"]
+        return self.get_price_ladder().unit_price(number_of_accounts)
+
+    def get_n_accounts_quotes(self, quantities):
+        """Returns the total price for each amount of accounts"""
+        return self.get_price_ladder().quotes(quantities)
 
     def set_account_price(self, step, price):
         """Sets the prices in the database"""
-        # Check if step is in the database
-        # If it is update the price
-        if self.prices.find_one({"step":step}, {"_id":0, "step":1, "price":1}):
-            # Update the price
-            self.prices.update_one({"step":step}, {"$set": {"price":price}})
-        else:
-            # Add the step and the price
-            self.prices.insert_one({"step":step, "price":price})
+        # The cached ladder is replaced under the lock so readers see the old or the new ladder, never a mix
+        with self.price_ladder_lock:
+            self.prices.update_one({"step":step}, {"$set": {"price":price}}, upsert=True)
+            if self.price_ladder is not None:
+                self.price_ladder = self.price_ladder.with_price(step, price)
     
     def del_account_price(self, step):
         """Deletes the price from the database"""
-        self.prices.delete_one({"step":step})
+        with self.price_ladder_lock:
+            self.prices.delete_one({"step":step})
+            if self.price_ladder is not None:
+                self.price_ladder = self.price_ladder.without_step(step)
 
     def get_account(self, account):
         """Returns an account from the database"""
         return self.accounts.find_one({"account":account})
 
     def get_number_of_available_accounts(self):
-        """Returns the count of available accounts from the database"""
+        """Returns the count of available accounts, from the stock counter once it is loaded"""
+        if self.stock.loaded:
+            return self.stock.get("cartable")
         return self.accounts.count_documents({"status":"cartable"})
 
+    def reconcile_stock(self):
+        """Recounts the accounts of every status in the database, returns {status: drift} for the counts that were off"""
+        changes = self.stock.begin_recount()
+        try:
+            counts = {group["_id"]: group["count"] for group in self.accounts.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])}
+        except Exception:
+            self.stock.abort_recount(changes)
+            raise
+        return self.stock.replace(counts, changes)
+
     def get_n_available_accounts(self, n):
         """Returns n available accounts from the database"""
         return list(self.accounts.find({"status":"cartable"}).limit(n))
     
+    def reserve_accounts(self, n, order_id, status="sold"):
+        """Atomically claims n cartable accounts for an order, returns them or None if there isn't enough stock"""
+        if n <= 0:
+            return []
+        claimed = []
+        # Each round seeks the (status, _id) index from a random _id between the first and the last cartable account,
+        # so concurrent orders rarely want the same accounts and a round costs the same whatever the size of the stock
+        bounds = [self.accounts.find_one({"status":"cartable"}, {"_id":1}, sort=[("_id", direction)]) for direction in (1, -1)]
+        while None not in bounds:
+            missing = n - len(claimed)
+            pivot = random_object_id(bounds[0]["_id"], bounds[1]["_id"])
+            candidates = list(self.accounts.find({"status":"cartable", "_id": {"$gte":pivot}}, {"_id":1, "account":1}).sort("_id", 1).limit(missing))
+            if len(candidates) < missing:
+                # Past the last cartable account, wrap around to the first ones
+                candidates += list(self.accounts.find({"status":"cartable", "_id": {"$lt":pivot}}, {"_id":1, "account":1}).sort("_id", 1).limit(missing - len(candidates)))
+            if len(candidates) < missing:
+                break
+            ids = [acc["_id"] for acc in candidates]
+            # Only the candidates that are still cartable get claimed, so two orders can't get the same account
+            result = self.accounts.update_many({"_id": {"$in": ids}, "status":"cartable"}, {"$set": {"status":status, "order_id":order_id}})
+            self.stock.move("cartable", status, result.modified_count)
+            if result.modified_count == missing:
+                claimed += candidates
+            else:
+                # Another order took some of the candidates, keep the ones that are ours and look for the rest
+                claimed += list(self.accounts.find({"_id": {"$in": ids}, "order_id":order_id}, {"_id":1, "account":1}))
+            if len(claimed) == n:
+                return claimed
+        # Fewer cartable accounts than the order still needs, give back everything this order claimed
+        self.release_accounts(order_id, status)
+        return None
+
+    def release_accounts(self, order_id, status="sold"):
+        """Puts the accounts claimed by an order back in stock"""
+        result = self.accounts.update_many({"order_id":order_id, "status":status}, {"$set": {"status":"cartable"}, "$unset": {"order_id":""}})
+        self.stock.move(status, "cartable", result.modified_count)
+
     def update_account_status(self, account, status):
         """Updates the state of an account"""
-        self.accounts.update_one({"account":account}, {"$set": {"status":status}})
+        previous = self.accounts.find_one_and_update({"account":account}, {"$set": {"status":status}}, {"_id":0, "status":1})
+        if previous is not None:
+            self.stock.move(previous.get("status"), status)
     
     def garbage_account(self, account):
         """Moves an account to the garbage collection"""
-        self.garbage_accounts.insert_one(self.accounts.find_one({"account":account}))
-        self.accounts.delete_one({"account":account})
+        account = self.accounts.find_one({"account":account})
+        self.garbage_accounts.insert_one(account)
+        if self.accounts.delete_one({"_id":account["_id"]}).deleted_count:
+            self.stock.add(account.get("status"), -1)
 
     def get_all_accounts(self):
         """Returns all accounts from the database"""
@@ -100,82 +407,215 @@ class MongoController:
         """Returns all cartable accounts from the database"""
         return self.accounts.find({"status":"cartable"})
     
+    def get_accounts_page(self, status=None, since=None, until=None, after=None, limit=1000):
+        """Returns up to limit accounts (_id and account) imported between since and until, in _id order after the _id after"""
+        # Paging on _id keeps every page an index range scan, however big the export is
+        query = {}
+        if status is not None:
+            query["status"] = status
+        id_range = {}
+        if after is not None:
+            id_range["$gt"] = after
+        if since is not None:
+            # _ids are created when an account is imported
+            id_range["$gte"] = ObjectId.from_datetime(since)
+        if until is not None:
+            id_range["$lt"] = ObjectId.from_datetime(until)
+        if id_range:
+            query["_id"] = id_range
+        return list(self.accounts.find(query, {"_id":1, "account":1}).sort("_id", 1).limit(limit))
+
     def insertOne_cartable_account(self, account):
         """Inserts a list of accounts into the database"""
         self.accounts.insert_one({"account":account, "status":"cartable"})
+        self.stock.add("cartable")
 
     def insertOne_account(self, account, status):
         """Inserts a list of accounts into the database"""
         self.accounts.insert_one({"account":account, "status":status})
+        self.stock.add(status)
+
+    def bulk_upsert_accounts(self, accounts, status):
+        """Inserts or updates the status of a list of accounts in one round trip, returns (inserted, updated)"""
+        if not accounts:
+            return 0, 0
+        # The previous status of the accounts that already exist keeps the stock counter right
+        previous = [acc.get("status") for acc in self.accounts.find({"account": {"$in": accounts}}, {"_id":0, "status":1})]
+        result = self.accounts.bulk_write([UpdateOne({"account":account}, {"$set": {"status":status}}, upsert=True) for account in accounts], ordered=False)
+        for old_status in previous:
+            self.stock.move(old_status, status)
+        self.stock.add(status, result.upserted_count)
+        return result.upserted_count, result.matched_count
 
     # FINANCE METHODS
 
     def insert_finance_statement(self, statement):
         """Inserts a finance statement into the database"""
-        self.finance.insert_one(statement)
+        # Keep the daily rollup of the statement up to date
+        rollup = UpdateOne(
+            {"Day": day_of(statement["Date"]), "Type": statement["Type"], "Payment_Method": statement["Payment_Method"]},
+            {"$inc": {"Total_Price": statement["Total_Price"], "Quantity": statement["Quantity"], "Count": 1}},
+            upsert=True)
+        with self.finance_lock:
+            self.finance.insert_one(statement)
+            if self.finance_rebuild is not None:
+                # The $out of the running rebuild would overwrite the $inc, it is applied once the new rollups are swapped in
+                self.finance_rebuild.append(rollup)
+            else:
+                self.finance_rollups.bulk_write([rollup])
+
+    def rebuild_finance_rollups(self):
+        """Rebuilds the daily rollups from all the finance statements, returns the number of rollups"""
+        # $out builds the rollups in a temporary collection and swaps it in with the indexes, dashboards never see a half-built collection
+        # Statements inserted after the rebuild starts are left out of it and have their rollup update queued instead,
+        # inserts never wait for the aggregation
+        with self.finance_rebuild_lock:
+            with self.finance_lock:
+                self.finance_rebuild = []
+                # ObjectIds of this process only grow, every statement before the cutoff is already inserted
+                cutoff = ObjectId()
+            try:
+                self.finance.aggregate([
+                    {"$match": {"_id": {"$lt": cutoff}}},
+                    {"$group": {
+                        "_id": {"Day": {"$dateFromParts": {"year": {"$year": "$Date"}, "month": {"$month": "$Date"}, "day": {"$dayOfMonth": "$Date"}}}, "Type": "$Type", "Payment_Method": "$Payment_Method"},
+                        "Total_Price": {"$sum": "$Total_Price"},
+                        "Quantity": {"$sum": "$Quantity"},
+                        "Count": {"$sum": 1},
+                    }},
+                    {"$project": {"_id": 0, "Day": "$_id.Day", "Type": "$_id.Type", "Payment_Method": "$_id.Payment_Method", "Total_Price": 1, "Quantity": 1, "Count": 1}},
+                    {"$out": self.finance_rollups.name},
+                ])
+            finally:
+                # Applied to the new rollups, or to the old ones if the rebuild failed
+                with self.finance_lock:
+                    queued, self.finance_rebuild = self.finance_rebuild, None
+                    if queued:
+                        self.finance_rollups.bulk_write(queued, ordered=False)
+        return self.finance_rollups.estimated_document_count()
+
+    def ensure_finance_rollups(self):
+        """Builds the daily rollups if there are finance statements but no rollups yet, returns the number of rollups built"""
+        if self.finance_rollups.find_one({}, {"_id":1}) is not None or self.finance.find_one({}, {"_id":1}) is None:
+            return 0
+        return self.rebuild_finance_rollups()
 
     def basic_finance_dashboard(self, start_date, end_date):
-        """Returns Total Revenue, Exepenses, Profit, Profit Margin, Number of Accounts Sold"""
-        # Should also return Revenue, Expense, and Profit by payment method
-
-        # Get all the finance statements
-        finance_statements = self.finance.find({"Date":{"$gte":start_date, "$lte":end_date}})
-
-        # Initialize the variables
-        revenue = {"total":0}
-        expenses = {"total":0}
-        profit = {}
+        """Returns Total Revenue, Expenses, Withdrawals, Profit, Profit Margin, Number of Accounts Sold"""
+        # Revenue, Expenses, Withdrawals and Profit are also returned by payment method
+        # Reads the daily rollups, whole days from start_date to end_date are included
+        groups = self.finance_rollups.aggregate([
+            {"$match": {"Day": {"$gte":day_of(start_date), "$lte":day_of(end_date)}}},
+            {"$group": {"_id": {"Type": "$Type", "Payment_Method": "$Payment_Method"}, "Total_Price": {"$sum": "$Total_Price"}, "Quantity": {"$sum": "$Quantity"}}},
+        ])
+        return self.build_finance_dashboard(groups)
+
+    def finance_timeseries(self, start_date, end_date, granularity="day"):
+        """Returns Revenue, Expenses, Withdrawals, Profit and Number of Accounts Sold per day, week or month"""
+        periods = {
+            "day": "$Day",
+            "week": {"$dateFromParts": {"isoWeekYear": {"$isoWeekYear": "$Day"}, "isoWeek": {"$isoWeek": "$Day"}, "isoDayOfWeek": 1}},
+            "month": {"$dateFromParts": {"year": {"$year": "$Day"}, "month": {"$month": "$Day"}, "day": 1}},
+        }
+        groups = self.finance_rollups.aggregate([
+            {"$match": {"Day": {"$gte":day_of(start_date), "$lte":day_of(end_date)}}},
+            {"$group": {"_id": {"Period": periods[granularity], "Type": "$Type"}, "Total_Price": {"$sum": "$Total_Price"}, "Quantity": {"$sum": "$Quantity"}}},
+        ])
+        series = {}
+        for group in groups:
+            row = series.setdefault(group["_id"]["Period"], {"period": group["_id"]["Period"], "revenue": 0, "expenses": 0, "withdrawals": 0, "n_accounts_sold": 0})
+            if group["_id"]["Type"] == "Income":
+                row["revenue"] += group["Total_Price"]
+                row["n_accounts_sold"] += group["Quantity"]
+            elif group["_id"]["Type"] == "Expense":
+                row["expenses"] += group["Total_Price"]
+            elif group["_id"]["Type"] == "Withdraw":
+                row["withdrawals"] += group["Total_Price"]
+        for row in series.values():
+            row["profit"] = row["revenue"] - row["expenses"]
+        return [series[period] for period in sorted(series)]
+
+    @staticmethod
+    def build_finance_dashboard(groups):
+        """Builds the dashboard from totals grouped by {Type, Payment_Method}"""
+        totals = {"Income": {"total":0}, "Expense": {"total":0}, "Withdraw": {"total":0}}
         n_accounts_sold = 0
-        
-        # Iterate through the finance statements
-        for statement in finance_statements:
-            # Add the revenue, expenses, and profit
-            if statement["Type"] == "Income":
-                revenue["total"] += statement["Total_Price"]
-                if statement["Payment_Method"] not in revenue:
-                    revenue[statement["Payment_Method"]] = 0
-                revenue[statement["Payment_Method"]] += statement["Total_Price"]
-                n_accounts_sold += statement["Quantity"]
-            elif statement["Type"] == "Expense":
-                expenses["total"] += statement["Total_Price"]
-                if statement["Payment_Method"] not in expenses:
-                    expenses[statement["Payment_Method"]] = 0
-                expenses[statement["Payment_Method"]] += statement["Total_Price"]
-        for key in revenue:
-            profit[key] = revenue[key] - expenses[key] if key in expenses else revenue[key]
+        for group in groups:
+            statement_type = group["_id"]["Type"]
+            payment_method = group["_id"]["Payment_Method"]
+            if statement_type not in totals:
+                continue
+            totals[statement_type]["total"] += group["Total_Price"]
+            totals[statement_type][payment_method] = totals[statement_type].get(payment_method, 0) + group["Total_Price"]
+            if statement_type == "Income":
+                n_accounts_sold += group["Quantity"]
+        revenue, expenses, withdrawals = totals["Income"], totals["Expense"], totals["Withdraw"]
+        # Withdrawals take money out of the business but don't change the profit
+        profit = {key: revenue.get(key, 0) - expenses.get(key, 0) for key in {**revenue, **expenses}}
         profit_margin = round(((profit["total"] / expenses["total"]))*100,2) if expenses["total"] != 0 else 'NaN'
 
-        return revenue, expenses, profit, profit_margin, n_accounts_sold
+        return revenue, expenses, withdrawals, profit, profit_margin, n_accounts_sold
 
     # CLIENT METHODS
 
     def insert_new_client(self, id, join_date, level, account_purchases, replacements, services, legit_check):
         """Inserts a new client into the database"""
         # Client should have the following format:
-        # {id, join_date, level, account_purchases, replacements,legit_check}
+        # {id, join_date, level, legit_check, total_accounts, total_replacements, revenue, total_revenue}
         # account_purchases should have the following format:
         # {date: datetime, n_accs: int, total_price: float, accounts: []}
         # replacements should have the following format:
         # {date: datetime, n_accs: int, accounts: []}
         # services should have the following format:
         # {date: datetime, service: str, n_accs: int, total_price: float}
-        self.clients.insert_one({"client_id":id, "register_date":join_date, "level":level, "account_purchases":account_purchases, "replacements": replacements, "service_purchases": services,"legit_check":legit_check})
+        # Purchases, replacements and services are stored in the Purchases collection,
+        # running totals are kept on the client document so profiles don't need to read them
+        account_revenue = sum(purchase["Total_price"] for purchase in account_purchases)
+        service_revenue = sum(service["Total_price"] for service in services)
+        self.clients.insert_one({"client_id":id, "register_date":join_date, "level":level, "legit_check":legit_check,
+                                 "total_accounts": sum(purchase["Number_of_accounts"] for purchase in account_purchases),
+                                 "total_replacements": len(replacements),
+                                 "revenue": {"account_purchase": account_revenue, "service": service_revenue},
+                                 "total_revenue": account_revenue + service_revenue})
+        history = [purchase_document(id, "account_purchase", purchase) for purchase in account_purchases]
+        history += [purchase_document(id, "replacement", replacement) for replacement in replacements]
+        history += [purchase_document(id, "service", service) for service in services]
+        if history:
+            self.purchases.insert_many(history)
 
     def get_all_clients(self):
         """Returns all clients from the database"""
-        return list(self.clients.find({}, {"_id":0}))
+        return list(self.clients.find({}, CLIENT_PROJECTION))
 
     def get_client(self, id):
         """Returns a client from the database"""
-        return self.clients.find_one({"client_id":id}, {"_id":0})
+        return self.clients.find_one({"client_id":id}, CLIENT_PROJECTION)
+
+    def get_client_profile(self, id):
+        """Returns the running totals of a client"""
+        return self.clients.find_one({"client_id":id}, {"_id":0, "client_id":1, "register_date":1, "level":1, "legit_check":1, "total_accounts":1, "total_replacements":1, "revenue":1, "total_revenue":1})
+
+    def get_client_history(self, id, purchase_type=None, page=0, page_size=10):
+        """Returns a page of the purchases, replacements and services of a client, newest first"""
+        query = {"client_id":id}
+        if purchase_type is not None:
+            query["Type"] = purchase_type
+        return list(self.purchases.find(query, {"_id":0, "client_id":0}).sort("Date", -1).skip(page * page_size).limit(page_size))
+
+    def count_client_history(self, id, purchase_type=None):
+        """Returns the number of purchases, replacements and services of a client"""
+        query = {"client_id":id}
+        if purchase_type is not None:
+            query["Type"] = purchase_type
+        return self.purchases.count_documents(query)
 
     def get_client_account_purchases(self, id):
         """Returns all account_purchases of a client from the database"""
-        return self.clients.find_one({"client_id":id}, {"_id":0, "account_purchases":1})["account_purchases"]
+        return list(self.purchases.find({"client_id":id, "Type":"account_purchase"}, {"_id":0, "client_id":0, "Type":0}).sort("Date", 1))
     
     def get_client_replacements(self, id):
         """Returns all replacements of a client from the database"""
-        return self.clients.find_one({"client_id":id}, {"_id":0, "replacements":1})["replacements"]
+        return list(self.purchases.find({"client_id":id, "Type":"replacement"}, {"_id":0, "client_id":0, "Type":0}).sort("Date", 1))
     
     def get_client_legit_check(self, id):
         """Returns all legit checks of a client from the database"""
@@ -183,38 +623,23 @@ class MongoController:
     
     def get_client_number_of_account_purchases(self, id):
         """Returns the number of account_purchases of a client from the database"""
-        total = 0
-        for purchase in self.get_client_account_purchases(id):
-            total += purchase["Number_of_accounts"]
-        return total
+        return self.clients.find_one({"client_id":id}, {"_id":0, "total_accounts":1}).get("total_accounts", 0)
     
     def get_client_number_of_replacements(self, id):
         """Returns the number of replacements of a client from the database"""
-        return len(self.get_client_replacements(id))
+        return self.clients.find_one({"client_id":id}, {"_id":0, "total_replacements":1}).get("total_replacements", 0)
     
     def get_client_services(self, id):
         """Returns all services of a client from the database"""
-        return self.clients.find_one({"client_id":id}, {"_id":0, "service_purchases":1})["service_purchases"]
+        return list(self.purchases.find({"client_id":id, "Type":"service"}, {"_id":0, "client_id":0, "Type":0}).sort("Date", 1))
     
     def get_client_revenue(self, id):
         """Returns the revenue of a client from the database"""
-        revenue = 0
-        for purchase in self.get_client_account_purchases(id):
-            revenue += purchase["Total_price"]
-        for service in self.get_client_services(id):
-            revenue += service["Total_price"]
-        return revenue
+        return self.clients.find_one({"client_id":id}, {"_id":0, "total_revenue":1}).get("total_revenue", 0)
     
     def get_client_revenue_per_type(self, id, purchase_type):
         """Returns the revenue of a client from the database"""
-        revenue = 0
-        if purchase_type == "account_purchase":
-            for purchase in self.get_client_account_purchases(id):
-                revenue += purchase["Total_price"]
-        elif purchase_type == "service":
-            for service in self.get_client_services(id):
-                revenue += service["Total_price"]
-        return revenue
+        return self.clients.find_one({"client_id":id}, {"_id":0, "revenue":1}).get("revenue", {}).get(purchase_type, 0)
     
     def get_client_level(self, id):
         """Returns the level of a client from the database"""
@@ -222,11 +647,13 @@ class MongoController:
     
     def add_new_client_purchase(self, id, purchase):
         """Appends a new purchase to a client"""
-        self.clients.update_one({"client_id":id}, {"$push": {"account_purchases":purchase}})
+        self.purchases.insert_one(purchase_document(id, "account_purchase", purchase))
+        self.clients.update_one({"client_id":id}, {"$inc": {"total_accounts":purchase["Number_of_accounts"], "revenue.account_purchase":purchase["Total_price"], "total_revenue":purchase["Total_price"]}})
 
     def add_new_client_replacement(self, id, replacement):
         """Appends a new replacement to a client"""
-        self.clients.update_one({"client_id":id}, {"$push": {"replacements":replacement}})
+        self.purchases.insert_one(purchase_document(id, "replacement", replacement))
+        self.clients.update_one({"client_id":id}, {"$inc": {"total_replacements":1}})
 
     def add_new_client_legit_check(self, id, legit_check):
         """Increments the legit check of a client"""
@@ -236,30 +663,89 @@ class MongoController:
         """Increment the level of a client"""
         self.clients.update_one({"client_id":id}, {"$inc": {"level":level}})
 
+    def backfill_client_counters(self, batch_size=500):
+        """Recomputes the running totals of every client from the Purchases collection, returns the number of clients with purchases"""
+        # Purchases still embedded in client documents aren't counted, migrate_client_purchases has to run first
+        # Clients without purchases end up with zeros
+        self.clients.update_many({}, {"$set": {"total_accounts":0, "total_replacements":0, "revenue": {"account_purchase":0, "service":0}, "total_revenue":0}})
+        totals = {}
+        for group in self.purchases.aggregate([{"$group": {"_id": {"client_id":"$client_id", "Type":"$Type"}, "Total_price": {"$sum":"$Total_price"}, "Number_of_accounts": {"$sum":"$Number_of_accounts"}, "Count": {"$sum":1}}}]):
+            client = totals.setdefault(group["_id"]["client_id"], {"total_accounts":0, "total_replacements":0, "revenue": {"account_purchase":0, "service":0}, "total_revenue":0})
+            if group["_id"]["Type"] == "account_purchase":
+                client["total_accounts"] += group["Number_of_accounts"]
+            elif group["_id"]["Type"] == "replacement":
+                client["total_replacements"] += group["Count"]
+            if group["_id"]["Type"] in client["revenue"]:
+                client["revenue"][group["_id"]["Type"]] += group["Total_price"]
+                client["total_revenue"] += group["Total_price"]
+        updates = [UpdateOne({"client_id":client_id}, {"$set": client}) for client_id, client in totals.items()]
+        for i in range(0, len(updates), batch_size):
+            self.clients.bulk_write(updates[i:i+batch_size], ordered=False)
+        return len(updates)
+
+    def migrate_client_purchases(self, batch_size=500):
+        """Moves the purchase arrays embedded in client documents to the Purchases collection, returns (clients, purchases) migrated"""
+        # Purchases get a deterministic _id so the migration can be run again if it stops halfway
+        legacy = {"$or": [{field: {"$exists": True}} for field in LEGACY_CLIENT_ARRAYS.values()]}
+        cursor = self.clients.find(legacy, {"client_id":1, **{field:1 for field in LEGACY_CLIENT_ARRAYS.values()}}).batch_size(50)
+        n_clients = n_purchases = 0
+        buffer, client_ids = [], []
+        for client in cursor:
+            for purchase_type, field in LEGACY_CLIENT_ARRAYS.items():
+                for i, purchase in enumerate(client.get(field) or []):
+                    document = purchase_document(client["client_id"], purchase_type, purchase)
+                    document["_id"] = f"{client['_id']}:{purchase_type}:{i}"
+                    buffer.append(document)
+            client_ids.append(client["_id"])
+            if len(buffer) >= batch_size:
+                n_purchases += self._flush_legacy_purchases(buffer, client_ids)
+                n_clients += len(client_ids)
+                buffer, client_ids = [], []
+        if client_ids:
+            n_purchases += self._flush_legacy_purchases(buffer, client_ids)
+            n_clients += len(client_ids)
+        return n_clients, n_purchases
+
+    def _flush_legacy_purchases(self, purchases, client_ids):
+        """Inserts migrated purchases and removes the arrays from their clients"""
+        if purchases:
+            try:
+                self.purchases.insert_many(purchases, ordered=False)
+            except BulkWriteError as e:
+                # Purchases already copied by a previous run
+                if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                    raise
+        self.clients.update_many({"_id": {"$in": client_ids}}, {"$unset": {field: "" for field in LEGACY_CLIENT_ARRAYS.values()}})
+        return len(purchases)
+
+    def get_client_leaderboard(self, metric="revenue", k=10):
+        """Returns the top k clients by revenue, accounts bought or replacements"""
+        # Sorted by the running totals, each one has a descending index
+        field = LEADERBOARD_FIELDS[metric]
+        return [{"client_id": client["client_id"], "value": client.get(field, 0)} for client in self.clients.find({}, {"_id":0, "client_id":1, field:1}).sort(field, -1).limit(k)]
+
     def get_client_with_most_revenue(self):
         """Returns the client with the most revenue"""
-        max_revenue = 0
-        max_client = None
-        for client in self.get_all_clients():
-            revenue = self.get_client_revenue(client["client_id"])
-            if revenue > max_revenue:
-                max_revenue = revenue
-                max_client = client
-        return max_client
+        leaderboard = self.get_client_leaderboard("revenue", 1)
+        if leaderboard == [] or leaderboard[0]["value"] <= 0:
+            return None
+        return self.get_client(leaderboard[0]["client_id"])
     
 
     # TICKET METHODS
 
     def insert_new_ticket(self, user_id, channel_id):
-        """Inserts a new ticket into the database"""
-        # Check if the ticket already exists
-        if self.get_ticket_by_user_id(user_id) == []:
+        """Inserts a new ticket into the database, returns False if the user already has one"""
+        # The unique user_id index turns the duplicate check into the insert itself
+        try:
             self.tickets.insert_one({"user_id":user_id, "channel_id": channel_id, "date":datetime.now()})
-        return self.get_ticket_by_user_id(user_id)
+        except DuplicateKeyError:
+            return False
+        return True
     
     def get_all_tickets(self):
         """Returns all tickets from the database"""
-        return self.tickets.find({}, {"_id":0})
+        return list(self.tickets.find({}, {"_id":0}))
 
     def get_ticket_by_user_id(self, user_id):
         """Returns all tickets from a user from the database"""
@@ -277,51 +763,152 @@ class MongoController:
         """Deletes a ticket from the database"""
         self.tickets.delete_one({"channel_id":channel_id})
 
-    # ORDER METHODS
+    # AUDIT METHODS
+
+    def insert_audit_entries(self, entries):
+        """Inserts a batch of audit log entries"""
+        if entries:
+            self.audit_log.insert_many(entries, ordered=False)
 
-    def create_new_checkout_session(self, user_id, n_accounts, payment_method=None, coin=None, network=None, txid=None):
-        """Creates a new checkout session"""
-        # Checkout session should have the following format:
-        # {user_id: int, n_accounts: int, total_price: float, coin: str, network: str, txid: str, createdAt: datetime, status: str}
+    # DEPOSIT METHODS
 
-        self.checkout_sessions.insert_one({"user_id":user_id, "n_accounts":n_accounts, "total_price":round(self.get_n_accounts_price(n_accounts)*n_accounts,2), "payment_method": payment_method, "coin":coin, "network":network, "txid":txid, "createdAt":datetime.now(), "status":"pending"})
+    def get_all_deposits(self):
+        """Returns all indexed Binance deposits from the database"""
+        return list(self.deposits.find({}, {"_id":0}))
+
+    def upsert_deposits(self, deposits):
+        """Inserts or updates Binance deposits, they are identified by their Binance id"""
+        if not deposits:
+            return
+        self.deposits.bulk_write([UpdateOne({"id":deposit["id"]}, {"$set": deposit}, upsert=True) for deposit in deposits], ordered=False)
+
+    # ORDER METHODS
+
+    # A checkout session goes pending -> paid -> completed, every transition below is one
+    # conditional find_one_and_update that returns the new session, or None if the session
+    # wasn't in the expected state anymore (expired, cancelled, paid by someone else...)
+
+    def open_checkout_session(self, user_id, n_accounts):
+        """Creates a pending checkout session for a user, returns (session, created), created is False if they already had one"""
+        new_id = ObjectId()
+        new_session = {"_id":new_id, "n_accounts":n_accounts, "total_price":round(self.get_n_accounts_price(n_accounts)*n_accounts,2), "payment_method": None, "coin":None, "network":None, "txid":None, "createdAt":datetime.now()}
+        try:
+            checkout_session = self.checkout_sessions.find_one_and_update({"user_id":user_id, "status":"pending"}, {"$setOnInsert": new_session}, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Another click created it in the meantime, the unique pending index makes it the only one
+            checkout_session = self.get_pending_checkout_session_by_user_id(user_id)
+        return checkout_session, checkout_session is not None and checkout_session["_id"] == new_id
+
+    def select_session_payment(self, id, payment_method, coin=None):
+        """Sets the payment method and coin of a pending checkout session"""
+        # Another coin means another network and amount, they are asked again
+        return self.checkout_sessions.find_one_and_update({"_id":ObjectId(id), "status":"pending"}, {"$set": {"payment_method":payment_method, "coin":coin, "network":None}, "$unset": {"crypto_amount":""}}, return_document=ReturnDocument.AFTER)
+
+    def select_session_network(self, id, coin, network, crypto_amount, decimals):
+        """Sets the network and the amount to pay of a pending checkout session, only if coin is still its coin"""
+        # crypto_amount is raised by the smallest step of decimals until no other open session of the coin and network
+        # is asked the same amount, so the payment matcher can tell apart clients who bought the same quantity
+        step = 10 ** -decimals
+        with self.amount_lock:
+            used = {round(session["crypto_amount"], decimals) for session in self.checkout_sessions.find(
+                {**payable_sessions(), "coin":coin, "network":network, "crypto_amount": {"$gte":crypto_amount, "$lt":crypto_amount + 1000 * step}, "_id": {"$ne":ObjectId(id)}},
+                {"_id":0, "crypto_amount":1})}
+            amount = round(crypto_amount, decimals)
+            while amount in used:
+                amount = round(amount + step, decimals)
+            return self.checkout_sessions.find_one_and_update({"_id":ObjectId(id), "status":"pending", "coin":coin}, {"$set": {"network":network, "crypto_amount":amount}}, return_document=ReturnDocument.AFTER)
+
+    def cancel_checkout_session(self, id, user_id):
+        """Deletes the pending checkout session of a user and releases its hold, returns it or None if it wasn't pending anymore"""
+        checkout_session = self.checkout_sessions.find_one_and_delete({"_id":ObjectId(id), "user_id":user_id, "status":"pending"})
+        if checkout_session is not None:
+            self.release_accounts(str(id), "held")
+        return checkout_session
+
+    def complete_checkout_session(self, id):
+        """Marks a paid checkout session as completed"""
+        return self.checkout_sessions.find_one_and_update({"_id":ObjectId(id), "status":"paid"}, {"$set": {"status":"completed"}}, return_document=ReturnDocument.AFTER)
 
     def get_pending_checkout_session_by_user_id(self, user_id):
         """Returns a pending checkout session from a user"""
         return self.checkout_sessions.find_one({"user_id":user_id, "status": "pending"})
 
+    def get_payable_checkout_session_by_user_id(self, user_id):
+        """Returns the newest checkout session of a user that a payment can complete, pending or expired within the grace period"""
+        return self.checkout_sessions.find_one({"user_id":user_id, **payable_sessions()}, sort=[("createdAt", -1)])
+
+    def get_checkout_session_by_txid(self, txid):
+        """Returns the checkout session paid by txid"""
+        return self.checkout_sessions.find_one({"txid":txid})
+
     def get_checkout_session_by_id(self, id):
         """Returns a checkout session from the database"""
         return self.checkout_sessions.find_one({"_id":ObjectId(id)})
     
-    def set_session_status(self, id, status):
-        """Sets the status of a checkout session"""
-        self.checkout_sessions.update_one({"_id":ObjectId(id)}, {"$set": {"status": status}})
-    
-    def set_session_txid(self, id, txid):
-        """Sets the txid of a checkout session"""
-        self.checkout_sessions.update_one({"_id":ObjectId(id)}, {"$set": {"txid": txid}})
-
-    def set_session_coin(self, id, coin):
-        """Sets the coin of a checkout session"""
-        self.checkout_sessions.update_one({"_id":ObjectId(id)}, {"$set": {"coin": coin}})
-
-    def set_session_network(self, id, network):
-        """Sets the network of a checkout session"""
-        self.checkout_sessions.update_one({"_id":ObjectId(id)}, {"$set": {"network": network}})
-
-    def set_session_payment_method(self, id, payment_method):
-        """Sets the payment method of a checkout session"""
-        self.checkout_sessions.update_one({"_id":ObjectId(id)}, {"$set": {"payment_method": payment_method}})
-    
-    def delete_checkout_session(self, id):
-        """Deletes a checkout session from the database"""
-        self.checkout_sessions.delete_one({"_id":ObjectId(id)})
+    def find_checkout_sessions_for_deposit(self, coin, network, amount, paid_at, tolerance, window, limit=50):
+        """Returns the payable checkout sessions a deposit can pay for"""
+        # Served by the (status, coin, network, crypto_amount) index, only sessions with a matching amount are read
+        return list(self.checkout_sessions.find({
+            **payable_sessions(),
+            "coin": coin,
+            "network": network,
+            "crypto_amount": {"$gte": amount / (1 + tolerance), "$lte": amount / (1 - tolerance)},
+            "createdAt": {"$gte": paid_at - window, "$lte": paid_at},
+        }).limit(limit))
+
+    def claim_checkout_session(self, id, txid):
+        """Marks a payable checkout session as paid with txid, returns the session or None if it was already paid or the txid was already used"""
+        # The unique txid index rejects a txid that already paid another session
+        try:
+            return self.checkout_sessions.find_one_and_update({"_id":ObjectId(id), **payable_sessions()}, {"$set": {"status":"paid", "txid":txid}}, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            return None
+
+    # HOLD METHODS
+    # The accounts of a checkout session are held (status "held", order_id = session id) from
+    # /buy until it is paid, cancelled or expired, every step goes through the order_id index
+
+    def hold_checkout_session(self, checkout_session):
+        """Holds the accounts of a checkout session, returns False if there isn't enough stock"""
+        if self.reserve_accounts(checkout_session["n_accounts"], str(checkout_session["_id"]), status="held") is None:
+            return False
+        self.checkout_sessions.update_one({"_id":checkout_session["_id"]}, {"$set": {"held":True}})
+        return True
+
+    def convert_hold(self, order_id, n):
+        """Turns the accounts held for an order into sold accounts, returns them or None if the hold doesn't have n accounts anymore"""
+        result = self.accounts.update_many({"order_id":order_id, "status":"held"}, {"$set": {"status":"sold"}})
+        self.stock.move("held", "sold", result.modified_count)
+        if result.modified_count != n:
+            return None
+        return list(self.accounts.find({"order_id":order_id, "status":"sold"}, {"_id":1, "account":1}))
+
+    def expire_checkout_session(self, id):
+        """Marks a checkout session that is still pending as expired and releases its hold, returns it or None if it was paid or cancelled"""
+        # The session is kept for EXPIRED_SESSION_GRACE so a deposit still confirming can pay it, with fresh stock
+        checkout_session = self.checkout_sessions.find_one_and_update({"_id":ObjectId(id), "status":"pending"}, {"$set": {"status":"expired", "expiredAt":datetime.now()}})
+        if checkout_session is not None:
+            self.release_accounts(str(id), "held")
+        return checkout_session
+
+    def get_pending_checkout_sessions(self):
+        """Returns the id, user and creation date of every pending checkout session"""
+        return list(self.checkout_sessions.find({"status":"pending"}, {"_id":1, "user_id":1, "createdAt":1}))
+
+    def release_orphan_holds(self):
+        """Releases the holds of checkout sessions that don't exist anymore, returns their order ids"""
+        held = self.accounts.distinct("order_id", {"status":"held"})
+        existing = {str(session["_id"]) for session in self.checkout_sessions.find({"_id": {"$in": [ObjectId(order_id) for order_id in held if ObjectId.is_valid(order_id)]}, "status": {"$in": ["pending", "paid"]}}, {"_id":1})}
+        orphans = [order_id for order_id in held if order_id not in existing]
+        for order_id in orphans:
+            self.release_accounts(order_id, "held")
+        return orphans
 
 def main():
 
     test = MongoController()
     print(test.get_client_with_most_revenue())
+    test.close()
 
 if __name__ == "__main__":
     main()  
@@ -0,0 +1,72 @@
+from checkout import CHECKOUT_WINDOW, DEPOSIT_SUCCESS, PAYMENT_TOLERANCE, amount_decimals, deposit_time, fulfil_checkout
+from mongo_controller import EXPIRED_SESSION_GRACE
+from datetime import datetime
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentMatcher:
+    """Completes pending checkout sessions when a matching deposit arrives, without the client running /autocheckout"""
+
+    def __init__(self, client, tolerance=PAYMENT_TOLERANCE, window=CHECKOUT_WINDOW):
+        self.client = client
+        self.mongo = client.mongo
+        self.tolerance = tolerance
+        self.window = window
+
+    def start(self):
+        """Starts listening to the deposit indexer"""
+        self.client.deposits.add_listener(self.on_deposits)
+
+    async def on_deposits(self, deposits):
+        """Called by the deposit indexer with the deposits that are new or changed"""
+        deposits = [deposit for deposit in deposits if deposit["status"] == DEPOSIT_SUCCESS]
+        results = await asyncio.gather(*[self.match(deposit) for deposit in deposits], return_exceptions=True)
+        for deposit, result in zip(deposits, results):
+            if isinstance(result, Exception):
+                logger.error("Could not match deposit %s", deposit["txId"], exc_info=result)
+
+    async def match(self, deposit):
+        """Finds the checkout session paid by a deposit and fulfils it"""
+        amount = float(deposit["amount"])
+        checkout_sessions = await self.mongo.find_checkout_sessions_for_deposit(deposit["coin"], deposit["network"], amount, deposit_time(deposit), self.tolerance, self.window)
+        # Every open session is asked a different amount, the exact one wins over the others in the tolerance
+        exact = [checkout_session for checkout_session in checkout_sessions if round(checkout_session["crypto_amount"], amount_decimals(deposit["coin"])) == round(amount, amount_decimals(deposit["coin"]))]
+        if exact:
+            checkout_sessions = exact
+        if len(checkout_sessions) != 1:
+            if checkout_sessions:
+                # The amount paid is off and close to several sessions, the client has to use /autocheckout with their txid
+                logger.info("Deposit %s matches several checkout sessions, waiting for /autocheckout", deposit["txId"])
+            else:
+                await self.report_unmatched(deposit)
+            return
+        channel = await self.get_ticket_channel(checkout_sessions[0]["user_id"])
+        if channel is None:
+            logger.warning("Checkout session %s was paid but the client has no ticket channel", checkout_sessions[0]["_id"])
+            return
+        # /autocheckout may have claimed the session or the txid in the meantime
+        checkout_session = await self.mongo.claim_checkout_session(checkout_sessions[0]["_id"], deposit["txId"])
+        if checkout_session is None:
+            return
+        await channel.send(f"<@{checkout_session['user_id']}> Payment of **{deposit['amount']} {deposit['coin']}** received")
+        if not await fulfil_checkout(self.mongo, checkout_session, channel.send):
+            await channel.send("There are not enough accounts available.\n For further support ping a Moderator")
+
+    async def report_unmatched(self, deposit):
+        """Tells the moderators about a recent deposit that no checkout session asked for, the client may have paid for nothing"""
+        # Older deposits are the history loaded at the first start, and a deposit /autocheckout used has its session
+        if datetime.now() - deposit_time(deposit) > self.window + EXPIRED_SESSION_GRACE:
+            return
+        if await self.mongo.get_checkout_session_by_txid(deposit["txId"]) is not None:
+            return
+        await self.client.audit.alert(f"Deposit of **{deposit['amount']} {deposit['coin']}** ({deposit['network']}) matches no checkout session, txid `{deposit['txId']}`")
+
+    async def get_ticket_channel(self, user_id):
+        """Returns the ticket channel of a user"""
+        channel_id = self.client.tickets.channel_of(int(user_id))
+        if channel_id is None:
+            return None
+        return self.client.get_channel(channel_id)
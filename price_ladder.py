@@ -0,0 +1,46 @@
+from bisect import bisect_right
+
+
+class PriceLadder:
+    """Tiered account prices held as sorted step/price lists, a quantity's tier is found by binary search"""
+
+    def __init__(self, prices):
+        prices = sorted(prices, key=lambda price: price["step"])
+        self.steps = [price["step"] for price in prices]
+        self.prices = [price["price"] for price in prices]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def unit_price(self, quantity):
+        """Returns the price per account when buying quantity accounts, None if quantity is below the first step"""
+        i = bisect_right(self.steps, quantity) - 1
+        if i < 0:
+            return None
+        return self.prices[i]
+
+    def quote(self, quantity):
+        """Returns the total price of quantity accounts"""
+        unit_price = self.unit_price(quantity)
+        if unit_price is None:
+            return None
+        return round(unit_price * quantity, 2)
+
+    def quotes(self, quantities):
+        """Returns {quantity: total price} for many quantities at once"""
+        return {quantity: self.quote(quantity) for quantity in quantities}
+
+    def tiers(self):
+        """Returns (step, next step or None, price) for every tier"""
+        next_steps = self.steps[1:] + [None]
+        return list(zip(self.steps, next_steps, self.prices))
+
+    def with_price(self, step, price):
+        """Returns a new ladder where step costs price"""
+        prices = {s: p for s, p in zip(self.steps, self.prices)}
+        prices[step] = price
+        return PriceLadder([{"step": s, "price": p} for s, p in prices.items()])
+
+    def without_step(self, step):
+        """Returns a new ladder without step"""
+        return PriceLadder([{"step": s, "price": p} for s, p in zip(self.steps, self.prices) if s != step])
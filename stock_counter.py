@@ -0,0 +1,77 @@
+import threading
+
+# Account statuses shown in the stock breakdown
+ACCOUNT_STATUSES = ("cartable", "held", "uncartable", "bad_account", "sold")
+
+
+class StockCounter:
+    """In-memory number of accounts per status, kept up to date by the writes of MongoController"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        # Reads fall back to the database until the first reconcile
+        self.loaded = False
+        # Changes made while the database is being recounted, one record per recount in progress
+        self._recounts = []
+
+    def get(self, status="cartable"):
+        """Returns the number of accounts with status"""
+        return self.counts.get(status, 0)
+
+    def has(self, n, status="cartable"):
+        """Returns False only if the counter is loaded and there are less than n accounts with status"""
+        return not self.loaded or self.get(status) >= n
+
+    def breakdown(self):
+        """Returns {status: number of accounts}, the usual statuses are always included"""
+        counts = dict.fromkeys(ACCOUNT_STATUSES, 0)
+        counts.update(self.counts)
+        return counts
+
+    def add(self, status, n=1):
+        """Adds n (can be negative) accounts to status"""
+        if n == 0:
+            return
+        with self._lock:
+            self._change(status, n)
+
+    def move(self, old_status, new_status, n=1):
+        """Moves n accounts from old_status to new_status"""
+        if old_status == new_status or n == 0:
+            return
+        with self._lock:
+            self._change(old_status, -n)
+            self._change(new_status, n)
+
+    def _change(self, status, n):
+        self.counts[status] = self.counts.get(status, 0) + n
+        for changes in self._recounts:
+            changes[status] = changes.get(status, 0) + n
+
+    def begin_recount(self):
+        """Starts recording the changes made while the database is recounted, returns the record to give to replace"""
+        changes = {}
+        with self._lock:
+            self._recounts.append(changes)
+        return changes
+
+    def abort_recount(self, changes):
+        """Stops recording the changes of a recount that failed"""
+        with self._lock:
+            self._recounts.remove(changes)
+
+    def replace(self, counts, changes=None):
+        """Replaces every count with the ones read from the database, returns {status: drift} for the counts that were off"""
+        with self._lock:
+            if changes is not None:
+                # The reads of the recount may have missed the writes made while it ran, they are applied on top
+                self._recounts.remove(changes)
+                counts = {status: counts.get(status, 0) + changes.get(status, 0) for status in set(counts) | set(changes)}
+            drift = {status: counts.get(status, 0) - self.counts.get(status, 0) for status in set(counts) | set(self.counts)}
+            # Swapping the dict keeps readers from seeing half of the update
+            self.counts = dict(counts)
+            was_loaded, self.loaded = self.loaded, True
+        if not was_loaded:
+            return {}
+        return {status: n for status, n in drift.items() if n != 0}
@@ -0,0 +1,66 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TicketRegistry:
+    """In-memory user_id <-> channel_id maps of the open tickets, written through to the Tickets collection"""
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.by_user = {}
+        self.by_channel = {}
+        # Users whose ticket channel is being created
+        self.opening = set()
+
+    async def load(self):
+        """Loads the open tickets from the database"""
+        tickets = await self.mongo.get_all_tickets()
+        self.by_user = {ticket["user_id"]: ticket["channel_id"] for ticket in tickets}
+        self.by_channel = {ticket["channel_id"]: ticket["user_id"] for ticket in tickets}
+        logger.info("Loaded %s tickets from the database", len(self.by_user))
+
+    def channel_of(self, user_id):
+        """Returns the ticket channel id of a user, None if they have no ticket"""
+        return self.by_user.get(user_id)
+
+    def user_of(self, channel_id):
+        """Returns the user id of a ticket channel, None if the channel isn't a ticket"""
+        return self.by_channel.get(channel_id)
+
+    def claim(self, user_id):
+        """Reserves the ticket of a user before its channel is created, returns False if they have one or it is being opened"""
+        # Nothing is awaited between the check and the claim, so a double click can't get two tickets
+        if user_id in self.by_user or user_id in self.opening:
+            return False
+        self.opening.add(user_id)
+        return True
+
+    def release(self, user_id):
+        """Gives up a claim whose channel couldn't be created"""
+        self.opening.discard(user_id)
+
+    async def open(self, user_id, channel_id):
+        """Registers the ticket of a claimed user"""
+        self.by_user[user_id] = channel_id
+        self.by_channel[channel_id] = user_id
+        self.opening.discard(user_id)
+        await self.mongo.insert_new_ticket(user_id, channel_id)
+
+    async def close(self, channel_id):
+        """Removes the ticket of a channel, returns its user id or None if the channel wasn't a ticket"""
+        user_id = self.by_channel.pop(channel_id, None)
+        if user_id is None:
+            return None
+        self.by_user.pop(user_id, None)
+        await self.mongo.delete_ticket_by_channel_id(channel_id)
+        return user_id
+
+    async def reconcile(self, channel_ids):
+        """Closes the tickets whose channel isn't in channel_ids anymore, returns their channel ids"""
+        orphans = [channel_id for channel_id in self.by_channel if channel_id not in channel_ids]
+        for channel_id in orphans:
+            await self.close(channel_id)
+        if orphans:
+            logger.warning("Closed %s tickets whose channel was deleted", len(orphans))
+        return orphans